@@ -0,0 +1,208 @@
+'''
+About: an asyncio backend for back translation with a pooled HTTP client, a
+concurrency limit, per-provider rate limiting and retry with backoff.
+'''
+import asyncio
+import random
+import time
+from random import sample
+
+import requests
+
+from utils import sessionRequest
+# aiohttp is optional: without it, the requests are sent by the synchronous
+# translators (sharing a pooled requests session) in a thread pool
+try:
+    import aiohttp
+    aiohttpExists = True
+except ImportError:
+    aiohttpExists = False
+
+
+# the default max requests per second of every provider
+RateLimits = {'baidu': 10.0, 'google': 5.0, 'papago': 10.0}
+# the max characters of a query of every provider (the google web page takes
+# the query in the url, so it is kept well below the url length limits)
+CharLimits = {'baidu': 6000, 'google': 1500, 'papago': 5000}
+
+
+class RateLimiter:
+    '''A token bucket: at most `rate` requests per second on average, with bursts
+    of up to `burst` requests.
+
+    Parameter:
+        - rate (float): the number of requests per second
+        - burst (int or None): the size of the bucket. Defaults to max(1, rate).
+    '''
+
+    def __init__(self, rate, burst=None):
+        self.rate = rate
+        self.burst = burst if burst else max(1.0, rate)
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+        self.lock = asyncio.Lock()
+
+    async def acquire(self):
+        '''Waits until a request may be sent.'''
+        async with self.lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+
+class RetryableError(Exception):
+    '''A failed request worth retrying (e.g., HTTP 429 or 5xx).'''
+
+
+# the failures that may go away on a retry; any other error (e.g., HTTP 401 or
+# a response body that cannot be parsed) fails the query at once
+RetryableErrors = (RetryableError, asyncio.TimeoutError,
+                   requests.exceptions.ConnectionError, requests.exceptions.Timeout)
+if aiohttpExists:
+    RetryableErrors += (aiohttp.ClientConnectionError,)
+
+
+class AsyncBackTranslate:
+    '''Concurrent back translation on top of a BackTranslate translator
+    (BaiduBackTranslator, GoogleBackTranslator or PapagoBackTranslator).
+
+    Parameter:
+        - back_translator (BackTranslate): the translator. If it defines `_request` and `_parse`
+            and aiohttp is installed, the requests are sent by a pooled aiohttp client;
+            otherwise, its `_translate` runs in a thread pool.
+        - concurrency (int): the max number of requests in flight. Defaults to 16.
+        - rate (float or None): the max requests per second. Defaults to `RateLimits` of the
+            provider (no limit if the provider is unknown).
+        - max_retries (int): the max number of retries of a request failing with HTTP 429, 5xx,
+            a connection error or a timeout. Other failures are not retried. Defaults to 5.
+        - backoff (float): the base delay (in seconds) of the exponential backoff. Defaults to 0.5.
+        - timeout (float): the timeout (in seconds) of a request. Defaults to 30.
+
+    #################
+    Basic Usage:
+    #################
+
+    >>> from back_translators import GoogleBackTranslator
+    >>> from async_back_trans import AsyncBackTranslate
+    >>> ABT = AsyncBackTranslate(GoogleBackTranslator('en'), concurrency=16)
+    >>> ABT.bulk_back_translate(['a list', 'of str'], mid_lang='vi')
+
+    Failed translations are returned as None, as in `BackTranslate.translate`.
+    '''
+
+    def __init__(self, back_translator, concurrency=16, rate=None,
+                 max_retries=5, backoff=0.5, timeout=30):
+        self.bt = back_translator
+        self.provider = getattr(back_translator, 'provider', None)
+        self.concurrency = concurrency
+        self.rate = rate if rate else RateLimits.get(self.provider)
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.timeout = timeout
+        self.use_aiohttp = aiohttpExists and hasattr(back_translator, '_request')
+
+    def _send_sync(self, query, src_lang, dst_lang):
+        '''Sends one request with the pooled requests session and returns the translated text.'''
+        if not hasattr(self.bt, '_request'):
+            return self.bt._translate(query, src_lang, dst_lang)
+
+        method, url, kwargs = self.bt._request(query, src_lang, dst_lang)
+        r = sessionRequest(method, url, timeout=self.timeout, **kwargs)
+        if r.status_code == 429 or r.status_code >= 500:
+            raise RetryableError(f'HTTP {r.status_code}')
+        r.raise_for_status()
+        return self.bt._parse(r.text)
+
+    async def _send(self, session, query, src_lang, dst_lang):
+        '''Sends one request and returns the translated text.'''
+        if session is None:
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(None, self._send_sync, query, src_lang, dst_lang)
+
+        method, url, kwargs = self.bt._request(query, src_lang, dst_lang)
+        async with session.request(method, url, **kwargs) as r:
+            body = await r.text()
+            if r.status == 429 or r.status >= 500:
+                raise RetryableError(f'HTTP {r.status}')
+            r.raise_for_status()
+        return self.bt._parse(body)
+
+    async def translate(self, session, query, src_lang, dst_lang):
+        '''Translates a query (with the lang codes already resolved), retrying the
+        RetryableErrors with exponential backoff and jitter. Returns None if the
+        translation fails.'''
+        cache = getattr(self.bt, 'cache', None)
+        if cache is not None:
+            cached = cache.get(query, src_lang, dst_lang, self.bt.provider)
+            if cached is not None:
+                return cached
+
+        for attempt in range(self.max_retries + 1):
+            try:
+                async with self.semaphore:
+                    if self.limiter is not None:
+                        await self.limiter.acquire()
+                    result = await self._send(session, query, src_lang, dst_lang)
+                if cache is not None and result is not None:
+                    cache.put(query, src_lang, dst_lang, self.bt.provider, result)
+                return result
+            except Exception as e:
+                if not isinstance(e, RetryableErrors) or attempt == self.max_retries:
+                    print(f'\033[32mCannot translate "{query}" from {src_lang} to {dst_lang}\033[0m')
+                    print('Reason being: ', e)
+                    return
+                await asyncio.sleep(self.backoff * 2 ** attempt * (1 + random.random()))
+
+    async def _back_translate(self, session, query, langs):
+        for i in range(len(langs) - 1):
+            if query is None:
+                return
+            query = await self.translate(session, query, langs[i], langs[i+1])
+        return query
+
+    async def _bulk_back_translate(self, queries, langs):
+        self.semaphore = asyncio.Semaphore(self.concurrency)
+        self.limiter = RateLimiter(self.rate) if self.rate else None
+        if not self.use_aiohttp:
+            return await asyncio.gather(*[self._back_translate(None, q, l)
+                                          for q, l in zip(queries, langs)])
+
+        connector = aiohttp.TCPConnector(limit=self.concurrency)
+        timeout = aiohttp.ClientTimeout(total=self.timeout)
+        async with aiohttp.ClientSession(connector=connector, timeout=timeout) as session:
+            return await asyncio.gather(*[self._back_translate(session, q, l)
+                                          for q, l in zip(queries, langs)])
+
+    def bulk_back_translate(self, query, src_lang=None, mid_lang=None, dst_lang=None):
+        '''Back translates a list of str concurrently, keeping the order.
+
+        Paratermers:
+            - query (list): a list of str.
+            - src_lang (None, str): if not given, defaults to the dst_lang of the translator.
+            - mid_lang (None, str, list): a lang name or a list of lang names to go through.
+                If not given, randomly select one for every query.
+            - dst_lang (None, str): if not given, defaults to the dst_lang of the translator.
+
+        Returns:
+            a list of back translated str (None if the translation failed).
+        '''
+        assert isinstance(query, list), 'query must be a list'
+        assert all(isinstance(q, str) for q in query), 'query must be a list of str when it\'s a list'
+
+        src_lang = self.bt._find_lang(src_lang) if src_lang else self.bt.dst_lang
+        dst_lang = self.bt._find_lang(dst_lang) if dst_lang else self.bt.dst_lang
+        if isinstance(mid_lang, str):
+            mid_lang = [self.bt._find_lang(mid_lang)]
+        elif isinstance(mid_lang, list):
+            mid_lang = [self.bt._find_lang(ml) for ml in mid_lang]
+
+        langs = []
+        for _ in query:
+            mid = mid_lang if mid_lang else sample(self.bt.lang_list, 1)
+            langs.append([src_lang] + mid + [dst_lang])
+        return asyncio.run(self._bulk_back_translate(query, langs))
@@ -3,11 +3,72 @@ Author: Zhengxiang (Jack) Wang
 GitHub: https://github.com/jaaack-wang 
 About: A simple model for back translation
 '''
+import os
+import sqlite3
+import unicodedata
 from random import sample
 from itertools import groupby
 from utils import find_lang_code
 
 
+class TranslationCache:
+    '''A persistent (sqlite) cache of translations keyed by the normalized text, 
+    the language pair and the provider. Every translation is committed right away, 
+    so a rerun after a crash does not translate the cached texts again.
+    
+    Parameter:
+        - path (str): the sqlite file of the cache
+    '''
+    
+    def __init__(self, path='translation_cache.db'):
+        self.path = path
+        self.hits = self.misses = 0
+        self._db = self._db_pid = None
+    
+    @property
+    def db(self):
+        '''The sqlite connection of the cache (one per process).'''
+        if self._db_pid != os.getpid():
+            self._db = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+            self._db.execute('CREATE TABLE IF NOT EXISTS translations '
+                             '(text TEXT, src TEXT, dst TEXT, provider TEXT, translation TEXT, '
+                             'PRIMARY KEY (text, src, dst, provider))')
+            self._db_pid = os.getpid()
+        return self._db
+    
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_db'] = state['_db_pid'] = None
+        return state
+    
+    @staticmethod
+    def normalize(text):
+        '''The cache key of a text: NFC-normalized without the surrounding whitespace.'''
+        return unicodedata.normalize('NFC', text).strip()
+    
+    def get(self, text, src_lang, dst_lang, provider):
+        '''Returns the cached translation of a text (None if not cached).'''
+        row = self.db.execute('SELECT translation FROM translations WHERE text = ? AND src = ? '
+                              'AND dst = ? AND provider = ?', 
+                              (self.normalize(text), src_lang, dst_lang, provider)).fetchone()
+        if row is None:
+            self.misses += 1
+            return
+        self.hits += 1
+        return row[0]
+    
+    def put(self, text, src_lang, dst_lang, provider, translation):
+        '''Caches the translation of a text.'''
+        self.db.execute('INSERT OR REPLACE INTO translations VALUES (?, ?, ?, ?, ?)', 
+                        (self.normalize(text), src_lang, dst_lang, provider, translation))
+    
+    def stats(self):
+        '''Returns the number of hits, misses and the hit rate.'''
+        total = self.hits + self.misses
+        return {'hits': self.hits, 'misses': self.misses, 
+                'hit_rate': self.hits / total if total else 0.0}
+
+
 class BackTranslate:
     '''A class method for back translation.
     
@@ -18,6 +79,7 @@ class BackTranslate:
             - (3) dst (str): destination language to translate the text into
         - lang_dic (dict): lang_dic used by the translator
         - dst_lang: default destination language
+        - cache (TranslationCache or None): the translation cache. Defaults to None (no cache).
     
     #################
     Basic Usage:
@@ -74,8 +136,11 @@ class BackTranslate:
             If mid_lang is given as a list, the randomly selected mid_lang will also be a list of same size. 
     '''
     
-    def __init__(self, translator, lang_dic, dst_lang):
+    provider = 'custom'
+    
+    def __init__(self, translator, lang_dic, dst_lang, cache=None):
         self._translate = translator
+        self.cache = cache
         self.lang_dic = lang_dic
         self.lang_dic_rev = {v.lower(): k for k, v in lang_dic.items()}
         self.dst_lang = self._find_lang(dst_lang)    
@@ -95,8 +160,16 @@ class BackTranslate:
         else:
             dst_lang = self._find_lang(dst_lang)
         
+        if self.cache is not None:
+            cached = self.cache.get(query, src_lang, dst_lang, self.provider)
+            if cached is not None:
+                return cached
+        
         try:
-            return self._translate(query, src_lang, dst_lang)
+            result = self._translate(query, src_lang, dst_lang)
+            if self.cache is not None and result is not None:
+                self.cache.put(query, src_lang, dst_lang, self.provider, result)
+            return result
         
         except Exception as e:
             print(f'\033[32mCannot translate "{query}" from {src_lang} to {dst_lang}\033[0m')
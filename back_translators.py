@@ -1,11 +1,11 @@
 from back_trans_model import BackTranslate
 from random import randint
 from hashlib import md5
-import requests
-from utils import getLangDict
+import json
+from utils import getLangDict, sessionRequest
 # if googletrans is installed, uses it to access google translate, 
 # otherwise, uses another simple web-scraping based func (may be less reliable)
-from utils import gTransByRegex
+from utils import gTransByRegex, gTransRequest, gTransParse
 try:
     from googletrans import Translator
     googletransExists = True
@@ -30,34 +30,42 @@ class BaiduBackTranslator(BackTranslate):
         - apiLink (str or None): the customized link to generate a vaild url to access the translation service.
         - lang_dic (str or None): lang_dic (lang code and name pairs) for Baidu Translate. If not given, uses 
             the `BaiduCommonLangDict` as in `langDict.json`. 
+        - cache (TranslationCache or None): the persistent translation cache. Defaults to None.
     '''
+    provider = 'baidu'
     
-    def __init__(self, appid, secretKey, dst_lang, apiLink=None, lang_dic=None):
+    def __init__(self, appid, secretKey, dst_lang, apiLink=None, lang_dic=None, cache=None):
         self.appid = appid
         self.secretKey = secretKey
-        if not apiLink:
-            self.apiLink = 'https://fanyi-api.baidu.com/api/trans/vip/translate'
+        self.apiLink = apiLink or 'https://fanyi-api.baidu.com/api/trans/vip/translate'
         if not lang_dic:
             lang_dic = LangDict['BaiduCommonLangDict']
-        super().__init__(self._translate, lang_dic, dst_lang)
+        super().__init__(self._translate, lang_dic, dst_lang, cache)
     
-    def _translate(self, query, src_lang, dst_lang):
-        
+    def _request(self, query, src_lang, dst_lang):
+        '''Returns the request (method, url and keyword arguments) of a query.'''
         salt = randint(12345, 123456)
         sign = self.appid + query + str(salt) + self.secretKey
         sign = md5(sign.encode('utf-8')).hexdigest()
         
         headers = {'Content-Type': 'application/x-www-form-urlencoded'}
         payload = {'appid': self.appid, 'q': query, 'from': src_lang, 
-                   'to': dst_lang, 'salt': salt, 'sign': sign}
-        
-        r = requests.post(self.apiLink, headers=headers, params=payload)
-        result = r.json()
+                   'to': dst_lang, 'salt': str(salt), 'sign': sign}
+        return 'POST', self.apiLink, {'headers': headers, 'params': payload}
+    
+    def _parse(self, body):
+        '''Extracts the translated text from a response body.'''
+        result = json.loads(body)
         out = []
         for res in result['trans_result']:
             out.append(res['dst'])
         return '\n'.join(out)
     
+    def _translate(self, query, src_lang, dst_lang):
+        method, url, kwargs = self._request(query, src_lang, dst_lang)
+        r = sessionRequest(method, url, **kwargs)
+        return self._parse(r.text)
+    
 
 class GoogleBackTranslator(BackTranslate):
     '''Back Translator based on Google Translate. If you do not have `googletrans` installed, 
@@ -69,20 +77,31 @@ class GoogleBackTranslator(BackTranslate):
             If not given, uses the `GoogleLangDict` as in `langDict.json`. 
         - use_googletrans (bool): whether to use googletrans to access Google Translate if 
             it is installed. Defaults to True.
+        - apiLink (str or None): the customized url template (query, dst_lang, src_lang) of the 
+            web-scraping func.
+        - cache (TranslationCache or None): the persistent translation cache. Defaults to None.
     '''
-    def __init__(self, dst_lang, lang_dict=None, use_googletrans=True):
+    provider = 'google'
+    
+    def __init__(self, dst_lang, lang_dict=None, use_googletrans=True, apiLink=None, cache=None):
         if not lang_dict:
             lang_dict = LangDict['GoogleLangDict'] 
         
         if not googletransExists:        
             use_googletrans = False
         
+        self.apiLink = apiLink or 'http://translate.google.cn/m?q=%s&tl=%s&sl=%s'
         if use_googletrans:
             self._translate = lambda q, sl, dl: Translator().translate(q, dl, sl).text
         else:
-            self._translate = lambda query, src_lang, dst_lang: gTransByRegex(query, src_lang, dst_lang)
+            self._translate = lambda query, src_lang, dst_lang: gTransByRegex(query, src_lang, dst_lang, 
+                                                                             gTransTmpUrl=self.apiLink)
+            # googletrans has its own client; only the web-scraping func can run on the async backend
+            self._request = lambda query, src_lang, dst_lang: gTransRequest(query, src_lang, dst_lang, 
+                                                                           gTransTmpUrl=self.apiLink)
+            self._parse = gTransParse
         
-        super().__init__(self._translate, lang_dict, dst_lang)
+        super().__init__(self._translate, lang_dict, dst_lang, cache)
 
 
 class PapagoBackTranslator(BackTranslate):
@@ -98,21 +117,32 @@ class PapagoBackTranslator(BackTranslate):
         - apiLink (str or None): the customized link to generate a vaild url to access the translation service.
         - lang_dic (str or None): lang_dic (lang code and name pairs) for Papago Translate. If not given, uses 
             the `PapagoLangDict` as in `langDict.json`. 
+        - cache (TranslationCache or None): the persistent translation cache. Defaults to None.
     '''
-    def __init__(self, clientId, clientKey, dst_lang, apiLink=None, lang_dict=None):
+    provider = 'papago'
+    
+    def __init__(self, clientId, clientKey, dst_lang, apiLink=None, lang_dict=None, cache=None):
         self.headers = {'X-Naver-Client-Id': clientId, 
                        'X-Naver-Client-Secret': clientKey, 
                        'Content-Type': 'application/x-www-form-urlencoded; charset=UTF-8'}
-        if not apiLink:
-            self.apiLink = 'https://openapi.naver.com/v1/papago/n2mt'
+        self.apiLink = apiLink or 'https://openapi.naver.com/v1/papago/n2mt'
         
         if not lang_dict:
             lang_dict = LangDict['PapagoLangDict']
         
-        super().__init__(self._translate, lang_dict, dst_lang)
+        super().__init__(self._translate, lang_dict, dst_lang, cache)
         
-    def _translate(self, query, src_lang, dst_lang):
+    def _request(self, query, src_lang, dst_lang):
+        '''Returns the request (method, url and keyword arguments) of a query.'''
         payload = {'text': query, 'source': src_lang, 'target': dst_lang}
-        r = requests.post(self.apiLink, headers=self.headers, data=payload)
-        result = r.json()
+        return 'POST', self.apiLink, {'headers': self.headers, 'data': payload}
+    
+    def _parse(self, body):
+        '''Extracts the translated text from a response body.'''
+        result = json.loads(body)
         return result['message']['result']['translatedText']
+    
+    def _translate(self, query, src_lang, dst_lang):
+        method, url, kwargs = self._request(query, src_lang, dst_lang)
+        r = sessionRequest(method, url, **kwargs)
+        return self._parse(r.text)
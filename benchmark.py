@@ -0,0 +1,281 @@
+import argparse
+import glob
+import os
+import random
+import time
+import numpy as np
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+from torch.utils import data
+
+from .dataset import DittoDataset, BucketBatchSampler, TokenBudgetBatchSampler
+from .blocking import TokenBlocker, MinHashLSH, token_candidates
+from .summarize import Summarizer, word_tokenize
+from .ditto import DittoModel, mean_pooling
+from .precision import Precision, autocast
+
+
+def pairs_per_second(dataset, batch_size=64):
+    """Return the number of pairs per second the DataLoader of a dataset produces.
+
+    Args:
+        dataset (DittoDataset): the dataset
+        batch_size (int, optional): the batch size
+
+    Returns:
+        float: the throughput in pairs per second
+    """
+    iterator = data.DataLoader(dataset=dataset,
+                               batch_size=batch_size,
+                               shuffle=False,
+                               num_workers=0,
+                               collate_fn=dataset.collate_fn)
+    start_time = time.time()
+    for _ in iterator:
+        pass
+    return len(dataset) / (time.time() - start_time)
+
+
+def bench_tokenize(hp):
+    """Compare per-item tokenization + pad with batch tokenization."""
+    for path in sorted(glob.glob(os.path.join(hp.data_dir, '*.txt'))):
+        results = []
+        for batch_tokenize in [False, True]:
+            dataset = DittoDataset(path,
+                                   max_len=hp.max_len,
+                                   lm=hp.lm,
+                                   batch_tokenize=batch_tokenize)
+            results.append(pairs_per_second(dataset, hp.batch_size))
+        print('%s: per_item=%.1f pairs/s, batched=%.1f pairs/s, speedup=%.2fx' %
+              (os.path.basename(path), results[0], results[1], results[1] / results[0]))
+
+
+def bench_padding(hp):
+    """Compare the padding ratio of shuffled and length-bucketed batches."""
+    for path in sorted(glob.glob(os.path.join(hp.data_dir, '*.txt'))):
+        dataset = DittoDataset(path, max_len=hp.max_len, lm=hp.lm)
+        lengths = dataset.lengths()
+        results = []
+        # bucket_size=1 sorts within a batch only, i.e., plain shuffling
+        for bucket_size in [1, 100]:
+            sampler = BucketBatchSampler(lengths, hp.batch_size,
+                                         shuffle=True,
+                                         bucket_size=bucket_size,
+                                         seed=123)
+            for _ in range(hp.n_epochs):
+                for _ in sampler:
+                    pass
+            results.append(sampler.padding_ratio())
+        print('%s: padding ratio shuffled=%.3f, bucketed=%.3f, tokens saved=%.1f%%' %
+              (os.path.basename(path), results[0], results[1],
+               100 * (1 - (1 - results[0]) / (1 - results[1]))))
+
+
+def bench_budget(hp):
+    """Compare fixed-size and token-budget batches at the same peak batch size
+    in tokens (i.e., the same memory)."""
+    for path in sorted(glob.glob(os.path.join(hp.data_dir, '*.txt'))):
+        lengths = DittoDataset(path, max_len=hp.max_len, lm=hp.lm).lengths()
+        fixed = BucketBatchSampler(lengths, hp.batch_size, shuffle=True, seed=123).batches()
+        peak = max(max(lengths[idx] for idx in batch) * len(batch) for batch in fixed)
+        budget = TokenBudgetBatchSampler(lengths, peak, shuffle=True, seed=123).batches()
+        print('%s: max_tokens=%d, fixed=%d batches (%.1f pairs), budget=%d batches (%.1f pairs), fewer steps=%.1f%%' %
+              (os.path.basename(path), peak, len(fixed), len(lengths) / len(fixed),
+               len(budget), len(lengths) / len(budget), 100 * (1 - len(budget) / len(fixed))))
+
+
+def read_matches(path):
+    """Return the distinct left/right records and the matching pairs of a data file"""
+    left_ids, right_ids, matches = {}, {}, set()
+    for line in open(path):
+        left, right, label = line.strip().split('\t')
+        left_idx = left_ids.setdefault(left, len(left_ids))
+        right_idx = right_ids.setdefault(right, len(right_ids))
+        if label == '1':
+            matches.add((left_idx, right_idx))
+    return list(left_ids), list(right_ids), matches
+
+
+def bench_blocking(hp):
+    """Report the pairs completeness against the candidate-set size of the
+    lexical blockers on the bundled data files."""
+    attrs = hp.attrs.split(',') if hp.attrs else None
+    blockers = {'token': lambda: TokenBlocker(attrs=attrs, max_df=hp.max_df),
+                'minhash': lambda: MinHashLSH(attrs=attrs, bands=hp.bands, rows=hp.rows)}
+    for path in sorted(glob.glob(os.path.join(hp.data_dir, '*.txt'))):
+        if '_trans' in path:
+            continue
+        lefts, rights, matches = read_matches(path)
+        right_idx = {right: idx for idx, right in enumerate(rights)}
+        left_idx = {left: idx for idx, left in enumerate(lefts)}
+        for name, blocker in blockers.items():
+            for k in [1, 5, 10, 50]:
+                start_time = time.time()
+                candidates = set((left_idx[left], right_idx[right]) for left, right in
+                                 token_candidates(lefts, rights, blocker(), max_candidates=k))
+                run_time = time.time() - start_time
+                completeness = len(candidates & matches) / max(1, len(matches))
+                reduction = 1 - len(candidates) / (len(lefts) * len(rights))
+                print('%s %s k=%d: candidates=%d, pairs_completeness=%.3f, reduction_ratio=%.4f, time=%.2fs' %
+                      (os.path.basename(path), name, k, len(candidates), completeness, reduction, run_time))
+
+
+def score_sentences_reference(sents, freqTable):
+    """The original O(tokens x vocab) scorer of Summarizer._score_sentences"""
+    sentenceValue = dict()
+    for word in sents:
+        word_count_in_sentence_except_stop_words = 0
+        for wordValue in freqTable:
+            if wordValue in word.lower():
+                word_count_in_sentence_except_stop_words += 1
+                if word in sentenceValue:
+                    sentenceValue[word] += freqTable[wordValue]
+                else:
+                    sentenceValue[word] = freqTable[wordValue]
+
+        if word in sentenceValue:
+            sentenceValue[word] = sentenceValue[word] / word_count_in_sentence_except_stop_words
+    return sentenceValue
+
+
+def bench_summarize(hp):
+    """Compare the summarizer's scorer with the reference scorer and check
+    that both give the same scores."""
+    summarizer = Summarizer(None, lm=hp.lm)
+    for path in sorted(glob.glob(os.path.join(hp.data_dir, '*.txt'))):
+        entries = []
+        for line in open(path):
+            for ent in line.strip().split('\t')[:2]:
+                entries.append((word_tokenize(ent), summarizer._create_frequency_table(ent)))
+
+        times = []
+        results = []
+        for scorer in [score_sentences_reference, summarizer._score_sentences]:
+            start_time = time.time()
+            results.append([scorer(words, freq_table) for words, freq_table in entries])
+            times.append(time.time() - start_time)
+        mismatches = sum(old != new for old, new in zip(*results))
+        print('%s: reference=%.2fs, summarizer=%.2fs, speedup=%.2fx, mismatches=%d' %
+              (os.path.basename(path), times[0], times[1], times[0] / times[1], mismatches))
+
+
+def bench_precision(hp):
+    """Compare the CPU training and inference throughput of fp32 and bf16."""
+    path = sorted(glob.glob(os.path.join(hp.data_dir, '*.txt')))[0]
+    dataset = DittoDataset(path, max_len=hp.max_len, lm=hp.lm, size=hp.size)
+    iterator = data.DataLoader(dataset=dataset,
+                               batch_size=hp.batch_size,
+                               shuffle=False,
+                               num_workers=0,
+                               collate_fn=dataset.collate_fn)
+    criterion = nn.CrossEntropyLoss()
+    for name in ['fp32', 'bf16']:
+        torch.manual_seed(123)
+        model = Precision(name, 'cpu').initialize(DittoModel(device='cpu', lm=hp.lm))
+        optimizer = torch.optim.AdamW(model.parameters(), lr=1e-5)
+
+        model.train()
+        start_time = time.time()
+        for x, x_mask, y in iterator:
+            optimizer.zero_grad()
+            with autocast(model):
+                prediction = model(x, x_mask)
+            loss = criterion(prediction.float(), y)
+            model.precision.backward(loss, optimizer)
+            model.precision.step(optimizer)
+        train_pps = len(dataset) / (time.time() - start_time)
+
+        model.eval()
+        start_time = time.time()
+        with torch.no_grad():
+            for x, x_mask, _ in iterator:
+                with autocast(model):
+                    model(x, x_mask)
+        infer_pps = len(dataset) / (time.time() - start_time)
+        print('%s %s: train=%.1f pairs/s, inference=%.1f pairs/s' %
+              (os.path.basename(path), name, train_pps, infer_pps))
+
+
+def mixda_reference(model, x1, x1_mask, x2, x2_mask):
+    """The original MixDA forward of DittoModel: one encoder call over the
+    concatenated batches at full padded length, without attention masks"""
+    enc = model.bert(torch.cat((x1, x2)))[0]
+    batch_size = len(x1)
+    enc1 = F.normalize(mean_pooling(enc[:batch_size], x1_mask), p=2, dim=1)
+    enc2 = F.normalize(mean_pooling(enc[batch_size:], x2_mask), p=2, dim=1)
+    aug_lam = np.random.beta(model.alpha_aug, model.alpha_aug)
+    return model.fc(enc1 * aug_lam + enc2 * (1.0 - aug_lam))
+
+
+def bench_mixda(hp):
+    """Compare the encoder tokens, FLOPs and time of a MixDA training epoch
+    with the original forward, the masked and trimmed forward, and the
+    latter skipping the augmented pass on hp.mixda_skip of the steps."""
+    path = sorted(glob.glob(os.path.join(hp.data_dir, '*.txt')))[0]
+    dataset = DittoDataset(path, max_len=hp.max_len, lm=hp.lm, size=hp.size, da=hp.da)
+    criterion = nn.CrossEntropyLoss()
+    for name, skip in [('reference', 0.0), ('masked', 0.0), ('masked+skip', hp.mixda_skip)]:
+        torch.manual_seed(123)
+        random.seed(123)
+        np.random.seed(123)
+        model = DittoModel(device='cpu', lm=hp.lm)
+        optimizer = torch.optim.AdamW(model.parameters(), lr=1e-5)
+        num_params = sum(p.numel() for p in model.bert.parameters())
+        # count the tokens the encoder runs on
+        tokens = [0]
+        model.bert.register_forward_pre_hook(
+            lambda module, args, kwargs: tokens.__setitem__(0, tokens[0] + args[0].numel()),
+            with_kwargs=True)
+        iterator = data.DataLoader(dataset=dataset,
+                                   batch_size=hp.batch_size,
+                                   shuffle=False,
+                                   num_workers=0,
+                                   collate_fn=dataset.collate_fn)
+
+        model.train()
+        start_time = time.time()
+        for i, (x1, x1_mask, x2, x2_mask, y) in enumerate(iterator):
+            optimizer.zero_grad()
+            if name == 'reference':
+                prediction = mixda_reference(model, x1, x1_mask, x2, x2_mask)
+            elif int((i + 1) * skip) > int(i * skip):
+                prediction = model(x1, x1_mask)
+            else:
+                prediction = model(x1, x1_mask, x2, x2_mask)
+            loss = criterion(prediction, y)
+            loss.backward()
+            optimizer.step()
+        run_time = time.time() - start_time
+        # forward + backward: about 6 FLOPs per parameter and token
+        print('%s %s: encoder tokens=%d, ~%.1f TFLOPs, time=%.2fs, %.1f pairs/s' %
+              (os.path.basename(path), name, tokens[0], 6 * num_params * tokens[0] / 1e12,
+               run_time, len(dataset) / run_time))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("bench", type=str, choices=['tokenize', 'padding', 'budget', 'blocking', 'summarize', 'precision', 'mixda'])
+    parser.add_argument("--data_dir", type=str, default='data/Structured')
+    parser.add_argument("--lm", type=str, default='distilbert')
+    parser.add_argument("--max_len", type=int, default=256)
+    parser.add_argument("--batch_size", type=int, default=64)
+    parser.add_argument("--n_epochs", type=int, default=3)
+    parser.add_argument("--max_df", type=float, default=0.1)
+    parser.add_argument("--bands", type=int, default=32)
+    parser.add_argument("--rows", type=int, default=2)
+    parser.add_argument("--attrs", type=str, default=None)
+    parser.add_argument("--size", type=int, default=512)
+    parser.add_argument("--da", type=str, default='del')
+    parser.add_argument("--mixda_skip", type=float, default=0.5)
+    hp = parser.parse_args()
+
+    benchmarks = {'tokenize': bench_tokenize,
+                  'padding': bench_padding,
+                  'budget': bench_budget,
+                  'blocking': bench_blocking,
+                  'summarize': bench_summarize,
+                  'precision': bench_precision,
+                  'mixda': bench_mixda}
+    benchmarks[hp.bench](hp)
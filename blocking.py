@@ -0,0 +1,347 @@
+import jsonlines
+import math
+import re
+import zlib
+import numpy as np
+
+from collections import defaultdict
+
+try:
+    import faiss
+    faissExists = True
+except ImportError:
+    faissExists = False
+
+
+def read_table(path):
+    """Read an entity table (a jsonlines file of attribute dictionaries)
+
+    Args:
+        path (str): the file path
+
+    Returns:
+        list of Dictionary: the records
+    """
+    with jsonlines.open(path) as reader:
+        return list(reader)
+
+
+class EmbeddingIndex:
+    """An exact inner-product index over normalized embeddings, so the
+    scores are cosine similarities. Uses FAISS if it is installed and
+    NumPy matrix products over chunks of the index otherwise, so the
+    memory of a search does not grow with the size of the index.
+
+    Args:
+        dim (int): the dimension of the embeddings
+        use_faiss (bool, optional): whether to use FAISS when it is installed
+        chunk_size (int, optional): the number of indexed embeddings scored
+            at a time without FAISS
+    """
+
+    def __init__(self, dim, use_faiss=True, chunk_size=16384):
+        self.dim = dim
+        self.chunk_size = chunk_size
+        self.use_faiss = use_faiss and faissExists
+        if self.use_faiss:
+            self.index = faiss.IndexFlatIP(dim)
+        else:
+            self.chunks = []
+            self.vecs = np.zeros((0, dim), dtype=np.float32)
+
+    def __len__(self):
+        if self.use_faiss:
+            return self.index.ntotal
+        return len(self.vecs) + sum(len(chunk) for chunk in self.chunks)
+
+    def add(self, vecs):
+        """Add a batch of embeddings (their ids follow the insertion order)"""
+        vecs = np.ascontiguousarray(vecs, dtype=np.float32)
+        if self.use_faiss:
+            self.index.add(vecs)
+        else:
+            self.chunks.append(vecs)
+
+    def search(self, queries, k):
+        """Return the top-k entries of every query.
+
+        Args:
+            queries (ndarray): the query embeddings of shape (n, dim)
+            k (int): the number of neighbors
+
+        Returns:
+            ndarray: the scores of shape (n, k), in decreasing order
+            ndarray: the ids of shape (n, k)
+        """
+        queries = np.ascontiguousarray(queries, dtype=np.float32)
+        k = min(k, len(self))
+        if self.use_faiss:
+            return self.index.search(queries, k)
+
+        if len(self.chunks) > 0:
+            self.vecs = np.concatenate([self.vecs] + self.chunks)
+            self.chunks = []
+        top = ids = None
+        for start in range(0, len(self.vecs), self.chunk_size):
+            # the top-k of the chunk, merged with the top-k so far
+            chunk_scores = queries @ self.vecs[start:start+self.chunk_size].T
+            chunk_k = min(k, chunk_scores.shape[1])
+            chunk_ids = np.argpartition(-chunk_scores, chunk_k - 1, axis=1)[:, :chunk_k]
+            chunk_top = np.take_along_axis(chunk_scores, chunk_ids, axis=1)
+            chunk_ids += start
+            if top is not None:
+                chunk_top = np.concatenate([top, chunk_top], axis=1)
+                chunk_ids = np.concatenate([ids, chunk_ids], axis=1)
+                best = np.argpartition(-chunk_top, k - 1, axis=1)[:, :k]
+                chunk_top = np.take_along_axis(chunk_top, best, axis=1)
+                chunk_ids = np.take_along_axis(chunk_ids, best, axis=1)
+            top, ids = chunk_top, chunk_ids
+        order = np.argsort(-top, axis=1)
+        return np.take_along_axis(top, order, axis=1), np.take_along_axis(ids, order, axis=1)
+
+
+def build_index(records, encoder, batch_size=4096, use_faiss=True):
+    """Embed all records of a table and index them.
+
+    Args:
+        records (list): the records
+        encoder (EntityEncoder): the entity encoder
+        batch_size (int, optional): the number of records embedded at a time
+        use_faiss (bool, optional): whether to use FAISS when it is installed
+
+    Returns:
+        EmbeddingIndex: the index (ids are the positions in records)
+    """
+    index = None
+    for start in range(0, len(records), batch_size):
+        vecs = encoder.encode(records[start:start+batch_size])
+        if index is None:
+            index = EmbeddingIndex(vecs.shape[1], use_faiss=use_faiss)
+        index.add(vecs)
+    return index
+
+
+def ann_candidates(left_records, right_records, encoder,
+                   k=10,
+                   batch_size=4096,
+                   use_faiss=True):
+    """Generate candidate pairs with an embedding nearest-neighbor search.
+
+    Every record of both tables is embedded once by the DittoModel encoder
+    and the right table is indexed, so blocking costs O((N+M)*k) pair
+    scores instead of the O(N*M) of scoring all pairs.
+
+    Args:
+        left_records (list): the records of the left table
+        right_records (list): the records of the right table
+        encoder (EntityEncoder): the entity encoder
+        k (int, optional): the number of candidates per left record
+        batch_size (int, optional): the number of records embedded at a time
+        use_faiss (bool, optional): whether to use FAISS when it is installed
+
+    Yields:
+        list: a [left record, right record] candidate row, the input format of
+            matcher.predict
+    """
+    if len(left_records) == 0 or len(right_records) == 0:
+        return
+    index = build_index(right_records, encoder, batch_size, use_faiss)
+    for start in range(0, len(left_records), batch_size):
+        batch = left_records[start:start+batch_size]
+        _, ids = index.search(encoder.encode(batch), k)
+        for left, neighbors in zip(batch, ids):
+            for idx in neighbors:
+                if idx >= 0:
+                    yield [left, right_records[idx]]
+
+
+def parse_record(text):
+    """Parse a COL/VAL serialized record into an attribute dictionary
+
+    Args:
+        text (str): the serialized record (e.g., 'COL title VAL ... COL price VAL ...')
+
+    Returns:
+        Dictionary: the attribute values
+    """
+    record = {}
+    for part in re.split(r'(?:^|\s)COL\s', ' ' + text):
+        if ' VAL' in part:
+            attr, _, value = part.partition(' VAL')
+            record[attr.strip()] = value.strip()
+    return record
+
+
+def record_tokens(record, attrs=None, min_len=2):
+    """Return the set of lowercased word tokens of a record.
+
+    Args:
+        record (Dictionary or str): the record (str if COL/VAL serialized)
+        attrs (list of str, optional): the attributes to use (all if not set)
+        min_len (int, optional): the min length of a token
+
+    Returns:
+        set of str: the tokens
+    """
+    if isinstance(record, str):
+        record = parse_record(record)
+    tokens = set()
+    for attr, value in record.items():
+        if attrs is None or attr in attrs:
+            tokens.update(token for token in re.findall(r'\w+', str(value).lower())
+                          if len(token) >= min_len)
+    return tokens
+
+
+class TokenBlocker:
+    """An incremental inverted index from tokens to records.
+
+    The candidates of a query are the indexed records sharing at least
+    min_shared tokens with it, ranked by the sum of the idf of the shared
+    tokens. Tokens appearing in more than max_df of the records are ignored,
+    which bounds the cost of a query; together with max_candidates this
+    trades recall for candidate-set size.
+
+    Args:
+        attrs (list of str, optional): the attributes to index (all if not set)
+        max_df (float, optional): the max document frequency of a used token
+        min_shared (int, optional): the min number of shared tokens
+    """
+
+    def __init__(self, attrs=None, max_df=0.1, min_shared=1):
+        self.attrs = attrs
+        self.max_df = max_df
+        self.min_shared = min_shared
+        self.postings = defaultdict(list)
+        self.size = 0
+
+    def add(self, record):
+        """Index a record. Returns its id."""
+        idx = self.size
+        for token in record_tokens(record, self.attrs):
+            self.postings[token].append(idx)
+        self.size += 1
+        return idx
+
+    def query(self, record, max_candidates=None):
+        """Return the ids of the candidates of a record, best first.
+
+        Args:
+            record (Dictionary or str): the query record
+            max_candidates (int, optional): the max number of candidates
+
+        Returns:
+            list of int: the candidate ids
+        """
+        max_postings = max(1, math.ceil(self.max_df * self.size))
+        scores = defaultdict(float)
+        shared = defaultdict(int)
+        for token in record_tokens(record, self.attrs):
+            posting = self.postings.get(token)
+            if posting is None or len(posting) > max_postings:
+                continue
+            idf = math.log(1.0 + self.size / len(posting))
+            for idx in posting:
+                scores[idx] += idf
+                shared[idx] += 1
+
+        ids = [idx for idx in scores if shared[idx] >= self.min_shared]
+        ids.sort(key=lambda idx: -scores[idx])
+        return ids[:max_candidates]
+
+
+def stable_hash(token):
+    """Return a hash of a token that is stable across processes"""
+    return zlib.crc32(token.encode('utf-8')) & 0x7fffffff
+
+
+class MinHashLSH:
+    """An incremental MinHash LSH index over the token sets of records.
+
+    The signature has bands * rows hash values. Two records become candidates
+    if their signatures agree on all rows of at least one band, which happens
+    with probability 1 - (1 - J^rows)^bands for a Jaccard similarity J: more
+    bands raise the recall, more rows shrink the candidate set.
+
+    Args:
+        attrs (list of str, optional): the attributes to index (all if not set)
+        bands (int, optional): the number of bands
+        rows (int, optional): the number of hash values per band
+        seed (int, optional): the seed of the hash functions
+    """
+
+    prime = (1 << 61) - 1
+
+    def __init__(self, attrs=None, bands=32, rows=2, seed=123):
+        self.attrs = attrs
+        self.bands = bands
+        self.rows = rows
+        rng = np.random.RandomState(seed)
+        num_perm = bands * rows
+        self.a = rng.randint(1, 1 << 31, size=num_perm).astype(np.uint64)
+        self.b = rng.randint(0, 1 << 31, size=num_perm).astype(np.uint64)
+        self.buckets = [defaultdict(list) for _ in range(bands)]
+        self.size = 0
+
+    def signature(self, record):
+        """Return the MinHash signature of a record (None if it has no token)"""
+        tokens = record_tokens(record, self.attrs)
+        if len(tokens) == 0:
+            return None
+        hashes = np.array([stable_hash(token) for token in tokens], dtype=np.uint64)
+        values = (np.outer(hashes, self.a) + self.b) % np.uint64(self.prime)
+        return values.min(axis=0)
+
+    def _band_keys(self, signature):
+        for band in range(self.bands):
+            yield band, signature[band*self.rows:(band+1)*self.rows].tobytes()
+
+    def add(self, record):
+        """Index a record. Returns its id."""
+        idx = self.size
+        signature = self.signature(record)
+        if signature is not None:
+            for band, key in self._band_keys(signature):
+                self.buckets[band][key].append(idx)
+        self.size += 1
+        return idx
+
+    def query(self, record, max_candidates=None):
+        """Return the ids of the candidates of a record, by number of shared bands.
+
+        Args:
+            record (Dictionary or str): the query record
+            max_candidates (int, optional): the max number of candidates
+
+        Returns:
+            list of int: the candidate ids
+        """
+        signature = self.signature(record)
+        if signature is None:
+            return []
+        counts = defaultdict(int)
+        for band, key in self._band_keys(signature):
+            for idx in self.buckets[band].get(key, []):
+                counts[idx] += 1
+        ids = sorted(counts, key=lambda idx: -counts[idx])
+        return ids[:max_candidates]
+
+
+def token_candidates(left_records, right_records, blocker, max_candidates=None):
+    """Generate candidate pairs with a lexical blocking index.
+
+    Args:
+        left_records (list): the records of the left table
+        right_records (list): the records of the right table (indexed)
+        blocker (TokenBlocker or MinHashLSH): an empty blocking index
+        max_candidates (int, optional): the max number of candidates per left record
+
+    Yields:
+        list: a [left record, right record] candidate row, the input format of
+            matcher.predict
+    """
+    for record in right_records:
+        blocker.add(record)
+    for left in left_records:
+        for idx in blocker.query(left, max_candidates):
+            yield [left, right_records[idx]]
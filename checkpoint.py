@@ -0,0 +1,162 @@
+import atexit
+import copy
+import glob
+import os
+import queue
+import random
+import re
+import threading
+import numpy as np
+import torch
+
+
+def snapshot(obj):
+    """Return a copy of a (nested) state on the CPU, detached from the
+    training tensors, so that training can go on while it is written.
+
+    Args:
+        obj: a tensor, or a dict/list/tuple of states
+
+    Returns:
+        the copy
+    """
+    if torch.is_tensor(obj):
+        return obj.detach().to('cpu', copy=True)
+    if isinstance(obj, dict):
+        return {key: snapshot(value) for key, value in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(snapshot(value) for value in obj)
+    return copy.deepcopy(obj)
+
+
+def rng_state():
+    """Return the states of the python, numpy and torch RNGs"""
+    state = {'python': random.getstate(),
+             'numpy': np.random.get_state(),
+             'torch': torch.get_rng_state()}
+    if torch.cuda.is_available():
+        state['cuda'] = torch.cuda.get_rng_state_all()
+    return state
+
+
+def set_rng_state(state):
+    """Restore the RNG states returned by rng_state"""
+    random.setstate(state['python'])
+    np.random.set_state(state['numpy'])
+    torch.set_rng_state(state['torch'])
+    if 'cuda' in state and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(state['cuda'])
+
+
+def load_checkpoint(path):
+    """Load a checkpoint written by AsyncCheckpointer onto the CPU"""
+    # the RNG states are not plain tensors
+    return torch.load(path, map_location='cpu', weights_only=False)
+
+
+class AsyncCheckpointer:
+    """Write checkpoints from a background thread.
+
+    save and save_step copy the state to the CPU on the calling thread and
+    return; a writer thread saves it to a temporary file, which is then
+    renamed over the target, so a checkpoint is either complete or absent
+    even if the process is killed mid-write (pending writes are finished
+    at exit). Step checkpoints are named step-<step>.pt and only the last
+    keep of them are kept.
+
+    Args:
+        directory (str): the directory of the step checkpoints
+        keep (int, optional): the number of step checkpoints to keep
+        max_pending (int, optional): the max number of states waiting to be
+            written (save blocks beyond it, bounding the memory)
+    """
+
+    def __init__(self, directory, keep=3, max_pending=2):
+        self.directory = directory
+        self.keep = keep
+        self.queue = queue.Queue(maxsize=max_pending)
+        self.error = None
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+        # finish the pending writes even if training fails
+        atexit.register(self.close)
+
+    def save(self, state, path):
+        """Write a state to a path in the background.
+
+        Args:
+            state (Dictionary): the state (e.g., of the model and the optimizer)
+            path (str): the output path
+        """
+        self._check()
+        self.queue.put((snapshot(state), path, False))
+
+    def save_step(self, state, step):
+        """Write the checkpoint of a training step in the background and
+        drop the checkpoints older than the last keep.
+
+        Args:
+            state (Dictionary): the training state
+            step (int): the number of optimizer steps so far
+        """
+        self._check()
+        path = os.path.join(self.directory, 'step-%08d.pt' % step)
+        self.queue.put((snapshot(state), path, True))
+
+    def checkpoints(self):
+        """Return the paths of the step checkpoints, oldest first"""
+        paths = glob.glob(os.path.join(self.directory, 'step-*.pt'))
+        return sorted(path for path in paths
+                      if re.fullmatch(r'step-\d+\.pt', os.path.basename(path)))
+
+    def latest(self):
+        """Return the path of the last step checkpoint (None if there is none)"""
+        paths = self.checkpoints()
+        return paths[-1] if len(paths) > 0 else None
+
+    def wait(self):
+        """Block until all pending checkpoints are written"""
+        self.queue.join()
+        self._check()
+
+    def close(self):
+        """Write the pending checkpoints and stop the writer thread"""
+        if not self.thread.is_alive():
+            return
+        self.queue.put(None)
+        self.thread.join()
+        self._check()
+
+    def _check(self):
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise RuntimeError('writing a checkpoint failed') from error
+
+    def _run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                self.queue.task_done()
+                return
+            state, path, prune = item
+            try:
+                self._write(state, path)
+                if prune:
+                    for old in self.checkpoints()[:-self.keep]:
+                        os.remove(old)
+            except Exception as e:
+                self.error = e
+            finally:
+                self.queue.task_done()
+
+    @staticmethod
+    def _write(state, path):
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            torch.save(state, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
@@ -1,3 +1,7 @@
+import hashlib
+import os
+import random
+import numpy as np
 import torch
 
 from torch.utils import data
@@ -16,6 +20,300 @@ def get_tokenizer(lm):
         return AutoTokenizer.from_pretrained(lm)
 
 
+def tokenize_pairs(tokenizer, pairs, max_len):
+    """Tokenize a list of (left, right) pairs with one call to the tokenizer.
+
+    Args:
+        tokenizer (PreTrainedTokenizer): the tokenizer
+        pairs (list of tuple): the (left, right) pairs
+        max_len (int): the max sequence length
+
+    Returns:
+        LongTensor: the token ID's of shape (batch_size, seq_len)
+        LongTensor: the attention mask of shape (batch_size, seq_len)
+    """
+    lefts, rights = zip(*pairs)
+    x = tokenizer(text=list(lefts),
+                  text_pair=list(rights),
+                  max_length=max_len,
+                  truncation=True,
+                  padding=True)
+    # the lists are already padded, so a single copy builds each tensor
+    x_mask = torch.LongTensor(x['attention_mask'])
+    # pad with 0 like DittoDataset.pad
+    x_ids = torch.LongTensor(x['input_ids']).masked_fill_(x_mask == 0, 0)
+    return x_ids, x_mask
+
+
+class TokenCache:
+    """On-disk cache of the tokenized pairs of a dataset.
+
+    The token ID's and attention masks of all pairs are stored as two flat
+    int32 arrays plus an int64 offsets index, so that pair i occupies
+    [offsets[i], offsets[i+1]). The arrays are opened with mmap, so every
+    DataLoader worker reads the same pages from the OS page cache.
+
+    Args:
+        cache_dir (str): the directory of the cache files
+        key (str): the cache key (see DittoDataset.cache_key)
+    """
+
+    fields = ['input_ids', 'attention_mask', 'offsets']
+
+    def __init__(self, cache_dir, key):
+        self.paths = {field: os.path.join(cache_dir, '%s.%s.npy' % (key, field))
+                      for field in self.fields}
+        self.arrays = None
+
+    def exists(self):
+        """Return True if all the cache files are on disk."""
+        return all(os.path.exists(path) for path in self.paths.values())
+
+    def build(self, tokenizer, pairs, max_len, batch_size=1024):
+        """Tokenize all pairs and write the cache files.
+
+        Args:
+            tokenizer (PreTrainedTokenizer): the tokenizer
+            pairs (list of tuple): the (left, right) pairs
+            max_len (int): the max sequence length
+            batch_size (int, optional): the number of pairs per tokenizer call
+
+        Returns:
+            None
+        """
+        ids, masks, offsets = [], [], [0]
+        for start in range(0, len(pairs), batch_size):
+            lefts, rights = zip(*pairs[start:start+batch_size])
+            x = tokenizer(text=list(lefts),
+                          text_pair=list(rights),
+                          max_length=max_len,
+                          truncation=True)
+            for input_ids, mask in zip(x['input_ids'], x['attention_mask']):
+                ids += input_ids
+                masks += mask
+                offsets.append(len(ids))
+
+        os.makedirs(os.path.dirname(self.paths['offsets']) or '.', exist_ok=True)
+        arrays = {'input_ids': np.asarray(ids, dtype=np.int32),
+                  'attention_mask': np.asarray(masks, dtype=np.int32),
+                  'offsets': np.asarray(offsets, dtype=np.int64)}
+        # write to a temporary file then rename, so that a crashed build
+        # or concurrent readers never see a partial cache; offsets go last
+        for field in self.fields:
+            tmp_path = self.paths[field] + '.tmp%d' % os.getpid()
+            with open(tmp_path, 'wb') as fout:
+                np.save(fout, arrays[field])
+            os.replace(tmp_path, self.paths[field])
+
+    def open(self):
+        """Memory-map the cache files (lazily, once per process)."""
+        if self.arrays is None:
+            self.arrays = {field: np.load(path, mmap_mode='r')
+                           for field, path in self.paths.items()}
+        return self.arrays
+
+    def lengths(self):
+        """Return the token length of every pair."""
+        return np.diff(self.open()['offsets'])
+
+    def __len__(self):
+        return len(self.open()['offsets']) - 1
+
+    def __getitem__(self, idx):
+        arrays = self.open()
+        start, end = arrays['offsets'][idx], arrays['offsets'][idx+1]
+        return {'input_ids': arrays['input_ids'][start:end].tolist(),
+                'attention_mask': arrays['attention_mask'][start:end].tolist()}
+
+    def __getstate__(self):
+        # do not pickle the mapped arrays into worker processes,
+        # each worker maps the same files instead
+        state = self.__dict__.copy()
+        state['arrays'] = None
+        return state
+
+
+class BucketBatchSampler(data.Sampler):
+    """Batch sampler that groups pairs of similar token length.
+
+    The indices are shuffled and cut into chunks of bucket_size batches.
+    Each chunk is sorted by length and split into batches, and the batches
+    are shuffled again, so the batches stay random across epochs while
+    padding to the longest pair of a batch wastes few tokens. Without
+    shuffle, the whole dataset is sorted by length.
+
+    Args:
+        lengths (list of int): the token length of every pair
+        batch_size (int): the number of pairs per batch
+        shuffle (bool, optional): whether to shuffle the batches
+        bucket_size (int, optional): the number of batches per sorted chunk
+        seed (int, optional): the seed of the shuffling (random if not set)
+    """
+
+    def __init__(self, lengths, batch_size, shuffle=True, bucket_size=100, seed=None):
+        self.lengths = lengths
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.bucket_size = bucket_size
+        self.seed = random.randrange(2**31) if seed is None else seed
+        self.epoch = 0
+        self.offset = 0
+        self.real_tokens = self.padded_tokens = 0
+
+    def set_epoch(self, epoch):
+        """Set the epoch, which determines the order of the batches."""
+        self.epoch = epoch
+
+    def skip(self, num_batches):
+        """Skip the first num_batches batches of the next epoch."""
+        self.offset = num_batches
+
+    def state_dict(self, num_batches=0):
+        """Return the state of the sampler, from which the batches of the
+        run continue.
+
+        Args:
+            num_batches (int, optional): the number of batches of the current
+                epoch already consumed (0 once the epoch is over). The
+                DataLoader may have drawn more batches ahead of training.
+
+        Returns:
+            Dictionary: the seed, and the epoch and offset the next epoch starts at
+        """
+        if num_batches > 0:
+            # replay the current epoch (epoch was advanced by __iter__)
+            return {'seed': self.seed, 'epoch': self.epoch - 1, 'offset': num_batches}
+        return {'seed': self.seed, 'epoch': self.epoch, 'offset': 0}
+
+    def load_state_dict(self, state):
+        """Restore a state returned by state_dict."""
+        self.seed = state['seed']
+        self.epoch = state['epoch']
+        self.offset = state['offset']
+
+    def batches(self):
+        """Return the batches of the current epoch.
+
+        Returns:
+            List of list of int: the indices of every batch
+        """
+        indices = list(range(len(self.lengths)))
+        if not self.shuffle:
+            chunks = [indices]
+        else:
+            rng = random.Random(self.seed + self.epoch)
+            rng.shuffle(indices)
+            chunk_size = self.batch_size * self.bucket_size
+            chunks = [indices[i:i+chunk_size] for i in range(0, len(indices), chunk_size)]
+
+        batches = []
+        for chunk in chunks:
+            chunk.sort(key=lambda idx: self.lengths[idx])
+            batches += [chunk[i:i+self.batch_size] for i in range(0, len(chunk), self.batch_size)]
+
+        if self.shuffle:
+            rng.shuffle(batches)
+        return batches
+
+    def padding_ratio(self):
+        """Return the fraction of pad tokens in the batches produced so far."""
+        if self.padded_tokens == 0:
+            return 0.0
+        return 1.0 - self.real_tokens / self.padded_tokens
+
+    def __iter__(self):
+        batches = self.batches()
+        self.epoch += 1
+        offset, self.offset = self.offset, 0
+        for batch in batches[offset:]:
+            lengths = [self.lengths[idx] for idx in batch]
+            self.real_tokens += sum(lengths)
+            self.padded_tokens += max(lengths) * len(lengths)
+            yield batch
+
+    def __len__(self):
+        return (len(self.lengths) + self.batch_size - 1) // self.batch_size
+
+
+class TokenBudgetBatchSampler(BucketBatchSampler):
+    """Batch sampler that fills every batch up to a number of tokens.
+
+    Like BucketBatchSampler, the shuffled indices are cut into chunks that
+    are sorted by length, but every chunk is split into batches whose padded
+    size (the longest pair times the number of pairs) is at most max_tokens,
+    so short pairs make large batches and long pairs small ones, and the
+    memory of a step stays bounded.
+
+    Args:
+        lengths (list of int): the token length of every pair
+        max_tokens (int): the max number of (padded) tokens per batch
+        shuffle (bool, optional): whether to shuffle the batches
+        bucket_size (int, optional): the number of batches per sorted chunk
+        seed (int, optional): the seed of the shuffling (random if not set)
+        max_size (int, optional): the max number of pairs per batch (no limit if not set)
+    """
+
+    def __init__(self, lengths, max_tokens, shuffle=True, bucket_size=100, seed=None,
+                 max_size=None):
+        # the average batch size, which sets the size of the sorted chunks
+        batch_size = max(1, max_tokens // max(1, int(np.mean(lengths))))
+        if max_size is not None:
+            batch_size = min(batch_size, max_size)
+        super().__init__(lengths, batch_size, shuffle=shuffle,
+                         bucket_size=bucket_size, seed=seed)
+        self.max_tokens = max_tokens
+        self.max_size = max_size
+        self._num_batches = None
+
+    def batches(self):
+        """Return the batches of the current epoch.
+
+        Returns:
+            List of list of int: the indices of every batch
+        """
+        indices = list(range(len(self.lengths)))
+        if not self.shuffle:
+            chunks = [indices]
+        else:
+            rng = random.Random(self.seed + self.epoch)
+            rng.shuffle(indices)
+            chunk_size = self.batch_size * self.bucket_size
+            chunks = [indices[i:i+chunk_size] for i in range(0, len(indices), chunk_size)]
+
+        batches = []
+        for chunk in chunks:
+            chunk.sort(key=lambda idx: self.lengths[idx])
+            batch = []
+            for idx in chunk:
+                # the chunk is sorted, so the new pair is the longest of the batch
+                if len(batch) > 0 and (self.lengths[idx] * (len(batch) + 1) > self.max_tokens or
+                                       len(batch) == self.max_size):
+                    batches.append(batch)
+                    batch = []
+                batch.append(idx)
+            if len(batch) > 0:
+                batches.append(batch)
+
+        if self.shuffle:
+            rng.shuffle(batches)
+        return batches
+
+    def epoch_batch_sizes(self, epoch):
+        """Return the number of pairs of every batch of an epoch."""
+        current = self.epoch
+        self.set_epoch(epoch)
+        sizes = [len(batch) for batch in self.batches()]
+        self.set_epoch(current)
+        return sizes
+
+    def __len__(self):
+        # the batches only change with the seed and the epoch
+        key = (self.seed, self.epoch)
+        if self._num_batches is None or self._num_batches[0] != key:
+            self._num_batches = (key, len(self.batches()))
+        return self._num_batches[1]
+
+
 class DittoDataset(data.Dataset):
     """EM dataset"""
 
@@ -24,8 +322,11 @@ class DittoDataset(data.Dataset):
                  max_len=256,
                  size=None,
                  lm='roberta',
-                 da=None):
+                 da=None,
+                 cache_dir=None,
+                 batch_tokenize=False):
         self.tokenizer = get_tokenizer(lm)
+        self.lm = lm
         self.pairs = []
         self.labels = []
         self.max_len = max_len
@@ -49,6 +350,63 @@ class DittoDataset(data.Dataset):
         else:
             self.augmenter = None
 
+        # pre-tokenize the pairs into a memory-mapped cache
+        self.cache = None
+        if cache_dir is not None:
+            self.cache = TokenCache(cache_dir, self.cache_key())
+            if not self.cache.exists():
+                self.cache.build(self.tokenizer, self.pairs, self.max_len)
+
+        # defer tokenization to the collate function (see batch_pad),
+        # not needed if the pairs are already cached
+        self.batch_tokenize = batch_tokenize and self.cache is None
+        self._lengths = None
+
+    def lengths(self, batch_size=1024):
+        """Return the token length of every pair (computed once).
+
+        Args:
+            batch_size (int, optional): the number of pairs per tokenizer call
+
+        Returns:
+            List of int: the number of tokens of each pair
+        """
+        if self._lengths is None:
+            if self.cache is not None:
+                self._lengths = self.cache.lengths().tolist()
+            else:
+                self._lengths = []
+                for start in range(0, len(self.pairs), batch_size):
+                    lefts, rights = zip(*self.pairs[start:start+batch_size])
+                    x = self.tokenizer(text=list(lefts),
+                                       text_pair=list(rights),
+                                       max_length=self.max_len,
+                                       truncation=True,
+                                       return_attention_mask=False)
+                    self._lengths += [len(ids) for ids in x['input_ids']]
+        return self._lengths
+
+    @property
+    def collate_fn(self):
+        """Return the collate function matching the items of the dataset."""
+        if self.batch_tokenize:
+            return self.batch_pad
+        return self.pad
+
+    def cache_key(self):
+        """Return the key of the token cache of this dataset.
+
+        The key is a hash of the content of the pairs, the lm and max_len,
+        so that a change to any of them invalidates the cache.
+
+        Returns:
+            str: the cache key
+        """
+        sha = hashlib.sha1()
+        sha.update(('%s\t%d\n' % (self.lm, self.max_len)).encode('utf-8'))
+        for s1, s2 in self.pairs:
+            sha.update(('%s\t%s\n' % (s1, s2)).encode('utf-8'))
+        return sha.hexdigest()
 
     def __len__(self):
         """Return the size of the dataset."""
@@ -68,11 +426,21 @@ class DittoDataset(data.Dataset):
         left = self.pairs[idx][0]
         right = self.pairs[idx][1]
 
+        # raw strings, tokenized by batch_pad
+        if self.batch_tokenize:
+            if self.da is not None:
+                combined = self.augmenter.augment_sent(left + ' [SEP] ' + right, self.da)
+                return (left, right), tuple(combined.split(' [SEP] ')), self.labels[idx]
+            return (left, right), self.labels[idx]
+
         # left + right
-        x = self.tokenizer(text=left,
-                           text_pair=right,
-                            max_length=self.max_len,
-                            truncation=True)
+        if self.cache is not None:
+            x = self.cache[idx]
+        else:
+            x = self.tokenizer(text=left,
+                               text_pair=right,
+                               max_length=self.max_len,
+                               truncation=True)
 
         # augment if da is set
         if self.da is not None:
@@ -134,3 +502,31 @@ class DittoDataset(data.Dataset):
                    torch.LongTensor(x12_mask),\
                    torch.LongTensor(y)
 
+    def batch_pad(self, batch):
+        """Tokenize and pad a list of raw dataset items into a train/test batch.
+
+        All (left, right) pairs of the batch are sent to the fast tokenizer
+        in a single call which pads them directly into tensors.
+
+        Args:
+            batch (list of tuple): a list of raw dataset items (batch_tokenize=True)
+
+        Returns:
+            same as DittoDataset.pad
+        """
+        if len(batch[0]) == 3:
+            x1_pairs, x2_pairs, y = zip(*batch)
+            # x1 and x2 are padded to the same length
+            x12, x12_mask = self._tokenize_pairs(x1_pairs + x2_pairs)
+            size = len(batch)
+            return x12[:size], x12_mask[:size], \
+                   x12[size:], x12_mask[size:], \
+                   torch.LongTensor(y)
+        else:
+            x12_pairs, y = zip(*batch)
+            x12, x12_mask = self._tokenize_pairs(x12_pairs)
+            return x12, x12_mask, torch.LongTensor(y)
+
+    def _tokenize_pairs(self, pairs):
+        """Tokenize a list of (left, right) pairs into padded LongTensors."""
+        return tokenize_pairs(self.tokenizer, pairs, self.max_len)
@@ -1,7 +1,11 @@
+import re
 from back_translators import GoogleBackTranslator
+from back_trans_model import TranslationCache
+from async_back_trans import AsyncBackTranslate, CharLimits
 GBT = GoogleBackTranslator('en', use_googletrans=False)
 
-def back_trans_col_based(f_path, col_num=0, subset_size=50):
+def back_trans_col_based(f_path, col_num=0, subset_size=None, concurrency=16,
+                         cache_path='translation_cache.db', max_attempts=3):
   '''
   A method to back translate text files before put into BERT. This
   method will back translate the value of specified column number 
@@ -9,40 +13,60 @@ def back_trans_col_based(f_path, col_num=0, subset_size=50):
   
   Parameters:
   f_path: path of the input text file (i.e., /data/train.txt).
-  col_num: the column number that need back translation, default=0.
+  col_num: the column number (or a list of column numbers) that need back translation, default=0.
+  subset_size: the max number of values translated by one request (only limited by the
+    character limit of the provider if None), default=None.
+  concurrency: the max number of requests in flight, default=16.
+  cache_path: the sqlite file caching the translations across runs (no cache if None).
+  max_attempts: the max number of requests of a value that fails to translate, default=3.
 
   Output:
   <file_name>_trans.txt file in the same directory of the input file.
   '''
+  if cache_path is not None:
+    GBT.cache = TranslationCache(cache_path)
+  col_nums = [col_num] if isinstance(col_num, int) else list(col_num)
+
   #read the input file (i.e., train.txt).
   file = open(f_path, "r")
   lines = file.readlines()
   file.close()
   
   translated_lines = []
-  transd_ls = []
-  transd_rs = []
-  lines_l = []
-  lines_r = []
 
+  #collect the values of the columns of both records, each distinct value once.
+  values = []
+  unique_ids = {}
   for line in lines:
     left, right, label = line.split('\t')
-    lines_l.append(left.split("VAL")[col_num+1].split("COL")[0])
-    lines_r.append(right.split("VAL")[col_num+1].split("COL")[0])
+    for record in [left, right]:
+      for col in col_nums:
+        value = record.split("VAL")[col+1].split("COL")[0].strip()
+        values.append(value)
+        if value != "" and value not in unique_ids:
+          unique_ids[value] = len(unique_ids)
+  unique_values = list(unique_ids)
+  report_dedup(values, unique_values, subset_size)
 
   #translation step
-  subsets_l = [lines_l[x:x+subset_size] for x in range(0, len(lines_l), subset_size)]
-  subsets_r = [lines_r[x:x+subset_size] for x in range(0, len(lines_r), subset_size)]
-  for i in range(len(subsets_l)):
-    transd_ls += subset_back_translate(subsets_l[i])
-    transd_rs += subset_back_translate(subsets_r[i])
-    print("processing subset", i+i*(subset_size-1), "to", i+(i+1)*(subset_size-1))
+  transd_values = translate_values(unique_values, subset_size, concurrency, max_attempts)
+  if GBT.cache is not None:
+    print("translation cache:", GBT.cache.stats())
 
+  #fan the translations back out to every occurrence.
+  idx = 0
   for i in range(len(lines)):
     left, right, label = lines[i].split('\t')
-    transd_l = replace_val(left, col_num, transd_ls[i] + " ")
-    transd_r = replace_val(right, col_num, transd_rs[i] + " ")
-    transd_line = "\t".join([transd_l, transd_r, label])
+    transd_records = []
+    for record in [left, right]:
+      for col in col_nums:
+        value = values[idx]
+        idx += 1
+        if value != "":
+          value = transd_values[unique_ids[value]].strip()
+        record = replace_val(record, col, " " + value + " ")
+      transd_records.append(record)
+    transd_line = "\t".join(transd_records + [label])
     translated_lines.append(transd_line)
 
   #Concatenate lines with translated lines to increase the size of the training set.
@@ -57,12 +81,90 @@ def back_trans_col_based(f_path, col_num=0, subset_size=50):
   file.writelines(new_lines)
   file.close()
 
-def subset_back_translate(subset):
-  str2translate = "\n\n\n".join(subset)
-  transd_str = GBT.back_translate(str2translate, mid_lang='vi')
-  transd_subset = transd_str.split("\n\n\n")
-  transd_subset[0] = " " + transd_subset[0]
-  return transd_subset
+def report_dedup(values, unique_values, subset_size):
+  #print how many requests and characters translating the distinct values saves.
+  char_limit = CharLimits.get(GBT.provider, 1000)
+  n_requests = len(pack_values(values, range(len(values)), char_limit, subset_size))
+  n_unique_requests = len(pack_values(unique_values, range(len(unique_values)), char_limit, subset_size))
+  n_chars = sum(len(value) for value in values)
+  n_unique_chars = sum(len(value) for value in unique_values)
+  print("values:", len(values), "distinct:", len(unique_values))
+  print("requests per hop:", n_unique_requests, "instead of", n_requests,
+        "(saved %d)" % (n_requests - n_unique_requests))
+  print("characters:", n_unique_chars, "instead of", n_chars,
+        "(saved %.1f%%)" % (100.0 * (n_chars - n_unique_chars) / max(1, n_chars)))
+
+def translate_values(values, subset_size=None, concurrency=16, max_attempts=3):
+  '''
+  Back translate a list of values, packing as many values as fit in the character
+  limit of the provider into one request. The values of a request are tagged with
+  their index, so the translations are aligned by tag instead of by line. The values
+  whose tag does not come back once are requested again in smaller packs, and alone
+  at the last attempt. A value that never translates keeps its original text.
+  '''
+  ABT = AsyncBackTranslate(GBT, concurrency=concurrency)
+  char_limit = CharLimits.get(GBT.provider, 1000)
+  transd_values = [None] * len(values)
+  pending = list(range(len(values)))
+  for attempt in range(max_attempts):
+    if len(pending) == 0:
+      break
+    if attempt == max_attempts - 1:
+      packs = [[i] for i in pending]
+    else:
+      packs = pack_values(values, pending, char_limit // 4**attempt, subset_size)
+    transd_strs = ABT.bulk_back_translate([frame_values([values[i] for i in pack]) for pack in packs],
+                                          mid_lang='vi')
+    for pack, transd_str in zip(packs, transd_strs):
+      for i, transd_value in zip(pack, unframe_translation(transd_str, len(pack))):
+        transd_values[i] = transd_value
+    pending = [i for i in pending if transd_values[i] is None]
+    print("attempt", attempt+1, ":", len(packs), "requests,", len(pending), "values left")
+
+  for i in pending:
+    transd_values[i] = values[i]
+  return transd_values
+
+def pack_values(values, ids, char_limit, subset_size=None):
+  #group the values of ids into packs whose framed text fits in char_limit.
+  packs = []
+  pack_len = 0
+  for i in ids:
+    #the text of the value, its tag and the separator (the tag is at most as long as that of len(ids))
+    framed_len = len(values[i]) + len("[[%d]] \n" % len(ids))
+    if len(packs) == 0 or pack_len + framed_len > char_limit or \
+        (subset_size is not None and len(packs[-1]) >= subset_size):
+      packs.append([])
+      pack_len = 0
+    packs[-1].append(i)
+    pack_len += framed_len
+  return packs
+
+def frame_values(values):
+  #a single value needs no tag.
+  if len(values) == 1:
+    return values[0]
+  return "\n".join("[[%d]] %s" % (i, value) for i, value in enumerate(values))
+
+TAG = re.compile(r'\[\[\s*(\d+)\s*\]\]')
+
+def unframe_translation(transd_str, n):
+  '''
+  Split the translation of n framed values by their tags. Returns the translated
+  values (None for a value whose tag is missing, repeated, or has no text, and for
+  the value before a missing tag, which may have absorbed the text of the next one).
+  '''
+  if transd_str is None:
+    return [None] * n
+  if n == 1:
+    return [transd_str.strip() or None]
+  parts = TAG.split(transd_str)
+  found = {}
+  for tag, text in zip(parts[1::2], parts[2::2]):
+    found.setdefault(int(tag), []).append(text.strip())
+  valid = [len(found.get(i, [])) == 1 and found[i][0] != "" for i in range(n)]
+  return [found[i][0] if valid[i] and (i == n-1 or i+1 in found) else None
+          for i in range(n)]
 
 def replace_val(in_str, col_num, dst_str):
   #Continue to split until we get the VAL to translate.
@@ -6,14 +6,15 @@ import torch.nn.functional as F
 import torch.optim as optim
 import random
 import numpy as np
-import sklearn.metrics as metrics
 import argparse
+import time
 
-from .dataset import DittoDataset
+from .dataset import BucketBatchSampler, TokenBudgetBatchSampler
 from torch.utils import data
-from transformers import AutoModel, AdamW, get_linear_schedule_with_warmup
+from transformers import AutoModel, get_linear_schedule_with_warmup
 from tensorboardX import SummaryWriter
-from apex import amp
+from .precision import Precision, resolve_precision, autocast
+from .checkpoint import AsyncCheckpointer, load_checkpoint, rng_state, set_rng_state
 
 lm_mp = {'roberta': 'roberta-base',
          'distilbert': 'distilbert-base-uncased'}
@@ -25,9 +26,19 @@ def mean_pooling(model_output, attention_mask):
     return torch.sum(token_embeddings * input_mask_expanded, 1) / torch.clamp(input_mask_expanded.sum(1), min=1e-9)
 
 class DittoModel(nn.Module):
-    """A baseline model for EM."""
+    """A baseline model for EM.
 
-    def __init__(self, device='cuda', lm='roberta', alpha_aug=0.8):
+    Args:
+        device (str, optional): the device of the model
+        lm (str, optional): the language model
+        alpha_aug (float, optional): the parameter of the MixDA beta distribution
+        mask_padding (bool, optional): whether the encoder gets the attention
+            mask and each batch is trimmed to its longest sequence. Models
+            trained before it was introduced attended the pad tokens, and are
+            loaded with False (see saved_mask_padding) to keep their logits.
+    """
+
+    def __init__(self, device='cuda', lm='roberta', alpha_aug=0.8, mask_padding=True):
         super().__init__()
         if lm in lm_mp:
             self.bert = AutoModel.from_pretrained(lm_mp[lm])
@@ -36,6 +47,7 @@ class DittoModel(nn.Module):
 
         self.device = device
         self.alpha_aug = alpha_aug
+        self.mask_padding = mask_padding
 
         # linear layer
         hidden_size = self.bert.config.hidden_size
@@ -43,96 +55,168 @@ class DittoModel(nn.Module):
         self.fc = torch.nn.Linear(hidden_size, 2)
 
 
+    def encode(self, x, x_mask):
+        """Encode a batch of sequences into normalized mean-pooled embeddings.
+
+        Args:
+            x (LongTensor): a batch of ID's
+            x_mask (LongTensor): the attention mask of x
+
+        Returns:
+            Tensor: the embeddings of shape (batch_size, emb_size)
+        """
+        x = x.to(self.device)
+        x_mask = x_mask.to(self.device)
+        if self.mask_padding:
+            # the batch is right-padded: drop the columns that are padding in
+            # every row and keep the encoder off the remaining pad tokens
+            seq_len = max(1, int(x_mask.sum(1).max()))
+            x = x[:, :seq_len]
+            x_mask = x_mask[:, :seq_len]
+            enc = self.bert(x, attention_mask=x_mask)[0]
+        else:
+            enc = self.bert(x)[0]
+        enc = mean_pooling(enc, x_mask)
+        return F.normalize(enc, p=2, dim=1)
+
     def forward(self, x1, x1_mask,x2=None,x2_mask=None):
         """Encode the left, right, and the concatenation of left+right.
 
         Args:
             x1 (LongTensor): a batch of ID's
+            x1_mask (LongTensor): the attention mask of x1
             x2 (LongTensor, optional): a batch of ID's (augmented)
+            x2_mask (LongTensor, optional): the attention mask of x2
 
         Returns:
             Tensor: binary prediction
         """
-        
-        x1 = x1.to(self.device) # (batch_size, seq_len)
-        x1_mask=x1_mask.to(self.device)
         if x2 is not None:
-            # MixDA
-            x2 = x2.to(self.device) # (batch_size, seq_len)
-            x2_mask=x2_mask.to(self.device)
-            #模型的optput不能直接用，要取第一个才是encoding
-            enc = self.bert(torch.cat((x1, x2)))[0]
-            batch_size = len(x1)
-            enc1 = enc[:batch_size] # (batch_size, emb_size)
-            enc2 = enc[batch_size:] # (batch_size, emb_size)
-            enc1=mean_pooling(enc1,x1_mask)
-            enc2=mean_pooling(enc2,x2_mask)
+            # MixDA: the original and the augmented batches are encoded
+            # separately (with mask_padding, each trimmed to its own longest
+            # sequence; without, the same as encoding their concatenation)
+            enc1 = self.encode(x1, x1_mask) # (batch_size, emb_size)
+            enc2 = self.encode(x2, x2_mask) # (batch_size, emb_size)
 
             aug_lam = np.random.beta(self.alpha_aug, self.alpha_aug)
-            enc1=F.normalize(enc1, p=2, dim=1)
-            enc2=F.normalize(enc2, p=2, dim=1)
             enc = enc1 * aug_lam + enc2 * (1.0 - aug_lam)
         else:
-            enc = self.bert(x1)[0]
-            enc=mean_pooling(enc,x1_mask)
-            enc=F.normalize(enc, p=2, dim=1)
+            enc = self.encode(x1, x1_mask)
+
+        # match the dtype of the classifier (fp16 under apex O2, fp32 otherwise)
+        return self.fc(enc.to(self.fc.weight.dtype)) # .squeeze() # .sigmoid()
+
 
-        return self.fc(enc.to(torch.float16)) # .squeeze() # .sigmoid()
+def saved_mask_padding(saved_state):
+    """Return the mask_padding of the DittoModel of a saved model.pt
+    (False for the checkpoints saved before it was introduced)"""
+    return saved_state.get('mask_padding', False)
 
 
-def evaluate(model, iterator, threshold=None):
+def threshold_sweep(probs, labels):
+    """Compute the precision, recall and F1 of every distinct threshold
+
+    The probabilities are sorted once and the true positives of predicting
+    1 for the top-k pairs are read from a cumulative sum, so every distinct
+    cutoff is evaluated in O(n log n) overall.
+
+    Args:
+        probs (ndarray): the probabilities of the 1-class
+        labels (ndarray): the labels (0 or 1)
+
+    Returns:
+        Dictionary: the arrays 'threshold', 'precision', 'recall' and 'f1',
+            where predicting probs > threshold gives the precision, recall, f1
+    """
+    order = np.argsort(-probs, kind='mergesort')
+    sorted_probs = probs[order]
+    tps = np.cumsum(labels[order])
+
+    # the last index of every run of equal probabilities
+    cutoffs = np.r_[np.flatnonzero(np.diff(sorted_probs)), len(probs) - 1]
+    tp = tps[cutoffs].astype(np.float64)
+    num_pred = cutoffs + 1.0
+    num_pos = float(tps[-1])
+
+    # probs > (the midpoint to the next lower distinct probability) selects
+    # the top pairs; a threshold away from every validation probability
+    # keeps the pairs at the boundary on the same side when the model is
+    # served with a slightly different numerical precision
+    run_probs = sorted_probs[cutoffs].astype(np.float64)
+    lowest = min(0.0, np.nextafter(run_probs[-1], -1.0))
+    thresholds = np.r_[(run_probs[:-1] + run_probs[1:]) / 2, lowest]
+
+    precision = tp / num_pred
+    recall = tp / num_pos if num_pos > 0 else np.zeros_like(tp)
+    f1 = 2 * tp / (num_pred + num_pos)
+    return {'threshold': thresholds,
+            'precision': precision,
+            'recall': recall,
+            'f1': f1}
+
+
+def evaluate(model, iterator, threshold=None, return_curve=False):
     """Evaluate a model on a validation/test dataset
 
     Args:
         model (DMModel): the EM model
         iterator (Iterator): the valid/test dataset iterator
         threshold (float, optional): the threshold on the 0-class
+        return_curve (bool, optional): whether to also return the PR curve
 
     Returns:
         float: the F1 score
         float (optional): if threshold is not provided, the threshold
             value that gives the optimal F1
+        Dictionary (optional): if return_curve is set, the precision,
+            recall and F1 of every threshold (see threshold_sweep)
     """
-    all_p = []
-    all_y = []
-    all_probs = []
+    size = len(iterator.dataset)
+    all_probs = torch.empty(size)
+    all_y = torch.empty(size, dtype=torch.long)
+    offset = 0
     with torch.no_grad():
         for batch in iterator:
-            '''
-            x_dic, y = batch
-            x=x_dic['input_ids']
-            x_mask=x_dic['attention_mask']
-            x_ten=torch.stack(x)#.float()
-            x_mask_ten=torch.stack(x_mask)#.float()
-            x_ten=torch.transpose(x_ten,0,1)
-            x_mask_ten=torch.transpose(x_mask_ten,0,1)
-            logits = model(x_ten,x_mask_ten)
-            '''
             x_ten,x_mask_ten,y=batch
-            logits = model(x_ten,x_mask_ten)
-            probs = logits.softmax(dim=1)[:, 1]
-            all_probs += probs.cpu().numpy().tolist()
-            all_y += y.cpu().numpy().tolist()
+            with autocast(model):
+                logits = model(x_ten,x_mask_ten)
+            probs = logits.float().softmax(dim=1)[:, 1]
+            all_probs[offset:offset+len(y)] = probs.float().cpu()
+            all_y[offset:offset+len(y)] = y
+            offset += len(y)
+
+    all_probs = all_probs[:offset].numpy()
+    all_y = all_y[:offset].numpy()
 
     if threshold is not None:
-        pred = [1 if p > threshold else 0 for p in all_probs]
-        f1 = metrics.f1_score(all_y, pred)
+        pred = all_probs > threshold
+        tp = np.sum(pred & (all_y == 1))
+        denominator = pred.sum() + all_y.sum()
+        f1 = float(2.0 * tp / denominator) if denominator > 0 else 0.0
         return f1
     else:
-        best_th = 0.5
-        f1 = 0.0 # metrics.f1_score(all_y, all_p)
+        curve = threshold_sweep(all_probs, all_y)
+        # the lowest threshold among the optimal ones
+        best = len(curve['f1']) - 1 - np.argmax(curve['f1'][::-1])
+        f1 = float(curve['f1'][best])
+        best_th = float(curve['threshold'][best])
+        if f1 == 0.0:
+            best_th = 0.5
+
+        if return_curve:
+            return f1, best_th, curve
+        return f1, best_th
 
-        for th in np.arange(0.0, 1.0, 0.05):
-            pred = [1 if p > th else 0 for p in all_probs]
-            new_f1 = metrics.f1_score(all_y, pred)
-            if new_f1 > f1:
-                f1 = new_f1
-                best_th = th
 
-        return f1, best_th
+def scale_gradients(optimizer, factor):
+    """Multiply the gradients of the parameters of an optimizer by a factor"""
+    for group in optimizer.param_groups:
+        for param in group['params']:
+            if param.grad is not None:
+                param.grad.mul_(factor)
 
 
-def train_step(train_iter, model, optimizer, scheduler, hp):
+def train_step(train_iter, model, optimizer, scheduler, hp, on_step=None):
     """Perform a single training step
 
     Args:
@@ -140,15 +224,33 @@ def train_step(train_iter, model, optimizer, scheduler, hp):
         model (DMModel): the model
         optimizer (Optimizer): the optimizer (Adam or AdamW)
         scheduler (LRScheduler): learning rate scheduler
-        hp (Namespace): other hyper-parameters (e.g., fp16)
+        hp (Namespace): other hyper-parameters (e.g., batch_size, max_tokens,
+                        mixda_skip, profile)
+        on_step (callable, optional): called after every optimizer step with
+            the number of batches consumed so far
 
     Returns:
-        None
+        Dictionary: the seconds spent waiting on data and computing (None if
+            hp.profile is not set)
     """
     criterion = nn.CrossEntropyLoss()
     # criterion = nn.MSELoss()
+    precision = getattr(model, 'precision', None) or Precision('fp32', model.device)
+    profile = getattr(hp, 'profile', False)
+    # with token-budget batches, the gradients of consecutive batches are
+    # accumulated until they cover hp.batch_size pairs, and averaged over
+    # the pairs of the step as in a single batch
+    accumulate = getattr(hp, 'max_tokens', None) is not None
+    accumulated = 0
+    # the fraction of the MixDA steps trained on the original batch only
+    mixda_skip = getattr(hp, 'mixda_skip', 0.0) or 0.0
+    data_time = compute_time = 0.0
+    optimizer.zero_grad()
+    end = time.perf_counter()
     for i, batch in enumerate(train_iter):
-        optimizer.zero_grad()
+        if profile:
+            start = time.perf_counter()
+            data_time += start - end
 
         if len(batch) == 3:
             '''
@@ -162,7 +264,8 @@ def train_step(train_iter, model, optimizer, scheduler, hp):
             x_mask_ten=torch.transpose(x_mask_ten,0,1)
             prediction = model(x_ten,x_mask_ten)'''
             x_ten,x_mask_ten,y=batch
-            prediction = model(x_ten,x_mask_ten)
+            with autocast(model):
+                prediction = model(x_ten,x_mask_ten)
         else:
             #这里的x1 x2现在是字典
             x1,x1_mask,x2,x2_mask, y = batch
@@ -176,21 +279,163 @@ def train_step(train_iter, model, optimizer, scheduler, hp):
             x2=torch.stack(x2)
             x2_mask=torch.stack(x2_mask)
             """
-            prediction = model(x1,x1_mask, x2,x2_mask)
-
-        loss = criterion(prediction, y.to(model.device))
-
-        if hp.fp16:
-            with amp.scale_loss(loss, optimizer) as scaled_loss:
-                scaled_loss.backward()
+            # skip the augmented pass on evenly spaced steps (no RNG is
+            # drawn, so the augmentation and mixing stay reproducible)
+            if int((i + 1) * mixda_skip) > int(i * mixda_skip):
+                x2 = x2_mask = None
+            with autocast(model):
+                prediction = model(x1,x1_mask, x2,x2_mask)
+
+        loss = criterion(prediction.float(), y.to(model.device))
+
+        if accumulate:
+            # the sum of the pair losses, divided by the number of pairs at the step
+            precision.backward(loss * len(y), optimizer)
+            accumulated += len(y)
         else:
-            loss.backward()
-        optimizer.step()
-        scheduler.step()
+            precision.backward(loss, optimizer)
+        if not accumulate or accumulated >= hp.batch_size:
+            if accumulate:
+                scale_gradients(optimizer, 1.0 / accumulated)
+            precision.step(optimizer)
+            scheduler.step()
+            optimizer.zero_grad()
+            accumulated = 0
+            if on_step is not None:
+                on_step(i + 1)
         if i % 10 == 0: # monitoring
             print(f"step: {i}, loss: {loss.item()}")
         del loss
 
+        if profile:
+            if torch.cuda.is_available():
+                torch.cuda.synchronize()
+            end = time.perf_counter()
+            compute_time += end - start
+
+    if accumulated > 0:
+        # the last partial effective batch of the epoch
+        scale_gradients(optimizer, 1.0 / accumulated)
+        precision.step(optimizer)
+        scheduler.step()
+        optimizer.zero_grad()
+        if on_step is not None:
+            on_step(i + 1)
+
+    if profile:
+        total = max(data_time + compute_time, 1e-9)
+        print(f"data wait: {data_time:.2f}s ({100 * data_time / total:.1f}%), "
+              f"compute: {compute_time:.2f}s ({100 * compute_time / total:.1f}%)")
+        return {'data_time': data_time, 'compute_time': compute_time}
+    return None
+
+
+def seed_worker(worker_id):
+    """Seed the python and numpy RNGs of a DataLoader worker (used by the
+    augmentation) from its torch seed, which the DataLoader derives from its
+    generator and the worker id.
+    """
+    seed = torch.initial_seed() % 2**32
+    random.seed(seed)
+    np.random.seed(seed)
+
+
+def create_loader(dataset, batch_size, shuffle, hp, max_tokens=None):
+    """Create the DataLoader of a dataset
+
+    Args:
+        dataset (DittoDataset): the dataset
+        batch_size (int): the batch size
+        shuffle (bool): whether to shuffle the dataset
+        hp (Namespace): Hyper-parameters (e.g., bucket, num_workers,
+                        prefetch_factor, checkpoint_every, resume)
+        max_tokens (int, optional): if set, batches are filled up to this
+            number of tokens instead of batch_size pairs
+
+    Returns:
+        DataLoader: the data loader
+    """
+    num_workers = getattr(hp, 'num_workers', 0)
+    # the shuffling and the worker seeds follow the seed of the run
+    generator = torch.Generator()
+    generator.manual_seed(torch.initial_seed())
+    kwargs = {'num_workers': num_workers,
+              'pin_memory': torch.cuda.is_available(),
+              'worker_init_fn': seed_worker,
+              'generator': generator,
+              'collate_fn': dataset.collate_fn}
+    if num_workers > 0:
+        # keep the workers (and their tokenizers) alive across epochs and
+        # prepare the next batches during the current step
+        kwargs['persistent_workers'] = True
+        kwargs['prefetch_factor'] = getattr(hp, 'prefetch_factor', 2)
+
+    if max_tokens is not None:
+        # at most batch_size pairs, so a batch never exceeds a step
+        sampler = TokenBudgetBatchSampler(dataset.lengths(),
+                                          max_tokens=max_tokens,
+                                          shuffle=shuffle,
+                                          max_size=batch_size)
+        return data.DataLoader(dataset=dataset,
+                               batch_sampler=sampler,
+                               **kwargs)
+
+    # the position of a BucketBatchSampler can be checkpointed
+    resumable = shuffle and (getattr(hp, 'checkpoint_every', None) or
+                             getattr(hp, 'resume', False))
+    if getattr(hp, 'bucket', False) or resumable:
+        # group pairs of similar length to reduce padding (without
+        # hp.bucket, a batch is only sorted within, i.e., plain shuffling)
+        sampler = BucketBatchSampler(dataset.lengths(),
+                                     batch_size=batch_size,
+                                     shuffle=shuffle,
+                                     bucket_size=100 if getattr(hp, 'bucket', False) else 1)
+        return data.DataLoader(dataset=dataset,
+                               batch_sampler=sampler,
+                               **kwargs)
+
+    return data.DataLoader(dataset=dataset,
+                           batch_size=batch_size,
+                           shuffle=shuffle,
+                           **kwargs)
+
+
+def num_optimizer_steps(train_iter, hp):
+    """Return the number of optimizer steps of a training run, i.e., the
+    number of steps of the LR scheduler.
+
+    Args:
+        train_iter (DataLoader): the train data loader
+        hp (Namespace): Hyper-parameters (e.g., batch_size, max_tokens, n_epochs)
+
+    Returns:
+        int: the number of steps
+    """
+    sampler = train_iter.batch_sampler
+    if getattr(hp, 'max_tokens', None) is None or \
+        not isinstance(sampler, TokenBudgetBatchSampler):
+        return len(train_iter) * hp.n_epochs
+
+    # replay the gradient accumulation of train_step over the batches of every epoch
+    num_steps = 0
+    for epoch in range(hp.n_epochs):
+        accumulated = 0
+        for size in sampler.epoch_batch_sizes(epoch):
+            accumulated += size
+            if accumulated >= hp.batch_size:
+                num_steps += 1
+                accumulated = 0
+        if accumulated > 0:
+            num_steps += 1
+    return num_steps
+
+
+def padding_ratio(iterator):
+    """Return the padding ratio of a bucketed DataLoader (None if not bucketed)."""
+    if isinstance(iterator.batch_sampler, BucketBatchSampler):
+        return iterator.batch_sampler.padding_ratio()
+    return None
+
 
 def train(trainset, validset, testset, run_tag, hp):
     """Train and evaluate the model
@@ -201,52 +446,101 @@ def train(trainset, validset, testset, run_tag, hp):
         testset (DittoDataset): the test set
         run_tag (str): the tag of the run
         hp (Namespace): Hyper-parameters (e.g., batch_size,
-                        learning rate, fp16)
+                        learning rate, precision, bucket, max_tokens,
+                        checkpoint_every, keep_checkpoints, resume)
 
     Returns:
         None
     """
-    padder = trainset.pad
     # create the DataLoaders
-    train_iter = data.DataLoader(dataset=trainset,
-                                 batch_size=hp.batch_size,
-                                 shuffle=True,
-                                 num_workers=0,
-                                 collate_fn=padder)
-    valid_iter = data.DataLoader(dataset=validset,
-                                 batch_size=hp.batch_size*16,
-                                 shuffle=False,
-                                 num_workers=0,
-                                 collate_fn=padder)
-    test_iter = data.DataLoader(dataset=testset,
-                                 batch_size=hp.batch_size*16,
-                                 shuffle=False,
-                                 num_workers=0,
-                                 collate_fn=padder)
+    train_iter = create_loader(trainset, hp.batch_size, True, hp,
+                               max_tokens=getattr(hp, 'max_tokens', None))
+    valid_iter = create_loader(validset, hp.batch_size*16, False, hp)
+    test_iter = create_loader(testset, hp.batch_size*16, False, hp)
+
+    # the checkpoints are written in the background: model.pt on the best
+    # dev F1, and the training state every hp.checkpoint_every optimizer
+    # steps and at the end of every epoch, from which hp.resume continues
+    checkpoint_every = getattr(hp, 'checkpoint_every', None)
+    resume = getattr(hp, 'resume', False)
+    checkpointer = None
+    if hp.save_model or checkpoint_every or resume:
+        checkpointer = AsyncCheckpointer(os.path.join(hp.logdir, hp.task, 'checkpoints'),
+                                         keep=getattr(hp, 'keep_checkpoints', 3))
+    state = None
+    if resume:
+        # hp.resume is a checkpoint path, or True for the last checkpoint
+        path = resume if isinstance(resume, str) else checkpointer.latest()
+        if path is None:
+            print('no checkpoint to resume from, starting a new run')
+        else:
+            print(f"resuming from {path}")
+            state = load_checkpoint(path)
+            # before counting the steps, which depend on the sampler seed
+            train_iter.batch_sampler.load_state_dict(state['sampler'])
 
     # initialize model, optimizer, and LR scheduler
     device = 'cuda' if torch.cuda.is_available() else 'cpu'
     model = DittoModel(device=device,
                        lm=hp.lm,
                        alpha_aug=hp.alpha_aug)
-    model = model.cuda()
-    optimizer = AdamW(model.parameters(), lr=hp.lr)
+    model = model.to(device)
+    # the defaults of the former transformers.AdamW (eps=1e-6, no weight decay)
+    optimizer = optim.AdamW(model.parameters(), lr=hp.lr, eps=1e-6, weight_decay=0.0)
 
-    if hp.fp16:
-        model, optimizer = amp.initialize(model, optimizer, opt_level='O2')
-    num_steps = (len(trainset) // hp.batch_size) * hp.n_epochs
+    precision = Precision(resolve_precision(hp), device)
+    model, optimizer = precision.initialize(model, optimizer)
+    num_steps = num_optimizer_steps(train_iter, hp)
     scheduler = get_linear_schedule_with_warmup(optimizer,
                                                 num_warmup_steps=0,
                                                 num_training_steps=num_steps)
 
+    start_epoch = 1
+    global_step = 0
+    best_dev_f1 = best_test_f1 = 0.0
+    if state is not None:
+        model.load_state_dict(state['model'])
+        optimizer.load_state_dict(state['optimizer'])
+        scheduler.load_state_dict(state['scheduler'])
+        precision.load_state_dict(state['precision'])
+        train_iter.generator.set_state(state['generator'])
+        set_rng_state(state['rng'])
+        start_epoch = state['epoch']
+        global_step = state['step']
+        best_dev_f1 = state['best_dev_f1']
+        best_test_f1 = state['best_test_f1']
+
+    def training_state(num_batches):
+        """The state of the run after num_batches batches of the epoch"""
+        return {'model': model.state_dict(),
+                'optimizer': optimizer.state_dict(),
+                'scheduler': scheduler.state_dict(),
+                'precision': precision.state_dict(),
+                'sampler': train_iter.batch_sampler.state_dict(num_batches),
+                # mid-epoch, the epoch is replayed from its start
+                'generator': epoch_generator if num_batches > 0 else train_iter.generator.get_state(),
+                'rng': rng_state(),
+                'epoch': epoch if num_batches > 0 else epoch + 1,
+                'step': global_step,
+                'best_dev_f1': best_dev_f1,
+                'best_test_f1': best_test_f1}
+
+    def on_step(num_batches):
+        nonlocal global_step
+        global_step += 1
+        if checkpoint_every and global_step % checkpoint_every == 0:
+            checkpointer.save_step(training_state(skipped + num_batches), global_step)
+
     # logging with tensorboardX
     writer = SummaryWriter(log_dir=hp.logdir)
 
-    best_dev_f1 = best_test_f1 = 0.0
-    for epoch in range(1, hp.n_epochs+1):
+    for epoch in range(start_epoch, hp.n_epochs+1):
         # train
         model.train()
-        train_step(train_iter, model, optimizer, scheduler, hp)
+        # the batches already trained on if resumed mid-epoch
+        skipped = getattr(train_iter.batch_sampler, 'offset', 0)
+        epoch_generator = train_iter.generator.get_state()
+        timing = train_step(train_iter, model, optimizer, scheduler, hp, on_step=on_step)
 
         # eval
         model.eval()
@@ -257,24 +551,36 @@ def train(trainset, validset, testset, run_tag, hp):
             best_dev_f1 = dev_f1
             best_test_f1 = test_f1
             if hp.save_model:
-                # create the directory if not exist
-                directory = os.path.join(hp.logdir, hp.task)
-                if not os.path.exists(directory):
-                    os.makedirs(directory)
-
                 # save the checkpoints for each component
                 ckpt_path = os.path.join(hp.logdir, hp.task, 'model.pt')
                 ckpt = {'model': model.state_dict(),
                         'optimizer': optimizer.state_dict(),
                         'scheduler': scheduler.state_dict(),
-                        'epoch': epoch}
-                torch.save(ckpt, ckpt_path)
+                        'epoch': epoch,
+                        'mask_padding': model.mask_padding}
+                checkpointer.save(ckpt, ckpt_path)
+
+        if checkpoint_every or resume:
+            checkpointer.save_step(training_state(0), global_step)
 
         print(f"epoch {epoch}: dev_f1={dev_f1}, f1={test_f1}, best_f1={best_test_f1}")
 
         # logging
         scalars = {'f1': dev_f1,
                    't_f1': test_f1}
+        # only the bucketed loaders report a padding ratio
+        pad_ratios = [(name, padding_ratio(iterator)) for name, iterator in
+                      [('train', train_iter), ('valid', valid_iter), ('test', test_iter)]]
+        pad_ratios = [(name, ratio) for name, ratio in pad_ratios if ratio is not None]
+        if len(pad_ratios) > 0:
+            if pad_ratios[0][0] == 'train':
+                scalars['pad_ratio'] = pad_ratios[0][1]
+            print(f"epoch {epoch}: padding ratio " +
+                  ', '.join(f"{name}={ratio:.3f}" for name, ratio in pad_ratios))
+        if timing is not None:
+            scalars.update(timing)
         writer.add_scalars(run_tag, scalars, epoch)
 
+    if checkpointer is not None:
+        checkpointer.close()
     writer.close()
@@ -0,0 +1,288 @@
+import hashlib
+import os
+import sqlite3
+import numpy as np
+import torch
+
+from collections import OrderedDict
+
+from .dataset import get_tokenizer
+from .precision import autocast
+
+
+def serialize(ent):
+    """Serialize a data entry into the COL/VAL format
+
+    Args:
+        ent (Dictionary or str): the data entry (str if already serialized)
+
+    Returns:
+        str: the serialized entry
+    """
+    if isinstance(ent, str):
+        return ent
+    content = ''
+    for attr in ent.keys():
+        content += 'COL %s VAL %s ' % (attr, ent[attr])
+    return content
+
+
+class EmbeddingCache:
+    """An LRU cache of entity embeddings keyed by the hash of the serialized
+    entity, optionally backed by an on-disk sqlite file that persists across
+    runs.
+
+    Args:
+        capacity (int, optional): the max number of embeddings kept in memory
+        path (str, optional): the sqlite file of the on-disk cache
+        namespace (str, optional): a prefix of the keys (e.g., the model path),
+            so that one file can hold the embeddings of several models
+    """
+
+    def __init__(self, capacity=100000, path=None, namespace=''):
+        self.capacity = capacity
+        self.namespace = namespace
+        self.memory = OrderedDict()
+        self.hits = self.misses = 0
+        self.path = path
+        self._db = self._db_pid = None
+
+    @property
+    def db(self):
+        """The sqlite connection of the on-disk cache (one per process)"""
+        if self.path is None:
+            return None
+        if self._db_pid != os.getpid():
+            self._db = sqlite3.connect(self.path, check_same_thread=False)
+            self._db.execute('CREATE TABLE IF NOT EXISTS embeddings (key TEXT PRIMARY KEY, vec BLOB)')
+            self._db_pid = os.getpid()
+        return self._db
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_db'] = state['_db_pid'] = None
+        return state
+
+    def key(self, text):
+        """Return the cache key of a serialized entity"""
+        return hashlib.sha1((self.namespace + '\t' + text).encode('utf-8')).hexdigest()
+
+    def get(self, key):
+        """Return the embedding of a key (None if not cached)"""
+        if key in self.memory:
+            self.memory.move_to_end(key)
+            self.hits += 1
+            return self.memory[key]
+        if self.db is not None:
+            row = self.db.execute('SELECT vec FROM embeddings WHERE key = ?', (key,)).fetchone()
+            if row is not None:
+                vec = np.frombuffer(row[0], dtype=np.float32)
+                self._remember(key, vec)
+                self.hits += 1
+                return vec
+        self.misses += 1
+        return None
+
+    def put(self, key, vec):
+        """Cache the embedding of a key"""
+        vec = np.asarray(vec, dtype=np.float32)
+        self._remember(key, vec)
+        if self.db is not None:
+            self.db.execute('INSERT OR REPLACE INTO embeddings VALUES (?, ?)', (key, vec.tobytes()))
+
+    def _remember(self, key, vec):
+        self.memory[key] = vec
+        self.memory.move_to_end(key)
+        while len(self.memory) > self.capacity:
+            self.memory.popitem(last=False)
+
+    def flush(self):
+        """Commit the on-disk cache"""
+        if self.db is not None:
+            self.db.commit()
+
+
+class EntityEncoder:
+    """Encode single entities with the encoder of a DittoModel (mean_pooling
+    + normalization), computing every distinct entity only once.
+
+    Args:
+        model (DittoModel): the model
+        lm (str, optional): the language model of the tokenizer
+        max_len (int, optional): the max sequence length of an entity
+        batch_size (int, optional): the batch size of the encoder
+        cache (EmbeddingCache, optional): the embedding cache
+        dk_injector (DKInjector, optional): the domain-knowledge injector
+    """
+
+    def __init__(self, model,
+                 lm='distilbert',
+                 max_len=256,
+                 batch_size=64,
+                 cache=None,
+                 dk_injector=None):
+        self.model = model
+        self.tokenizer = get_tokenizer(lm)
+        self.max_len = max_len
+        self.batch_size = batch_size
+        self.cache = EmbeddingCache() if cache is None else cache
+        self.dk_injector = dk_injector
+
+    def _encode_texts(self, texts):
+        """Run the encoder over a list of serialized entities"""
+        vecs = []
+        with torch.no_grad():
+            for start in range(0, len(texts), self.batch_size):
+                x = self.tokenizer(texts[start:start+self.batch_size],
+                                   max_length=self.max_len,
+                                   truncation=True,
+                                   padding=True)
+                x_mask = torch.LongTensor(x['attention_mask'])
+                x_ids = torch.LongTensor(x['input_ids']).masked_fill_(x_mask == 0, 0)
+                with autocast(self.model):
+                    vecs.append(self.model.encode(x_ids, x_mask).float().cpu().numpy())
+        return np.concatenate(vecs)
+
+    def encode(self, entities):
+        """Return the embeddings of a list of entities.
+
+        Args:
+            entities (list): the data entries (Dictionary or str)
+
+        Returns:
+            ndarray: the embeddings of shape (len(entities), emb_size)
+        """
+        texts = [serialize(ent) for ent in entities]
+        if self.dk_injector is not None:
+            texts = [self.dk_injector.transform(text) for text in texts]
+        keys = [self.cache.key(text) for text in texts]
+
+        vecs = {}
+        missing = {}
+        for key, text in zip(keys, texts):
+            if key in vecs or key in missing:
+                continue
+            vec = self.cache.get(key)
+            if vec is None:
+                missing[key] = text
+            else:
+                vecs[key] = vec
+
+        if len(missing) > 0:
+            new_vecs = self._encode_texts(list(missing.values()))
+            for key, vec in zip(missing.keys(), new_vecs):
+                self.cache.put(key, vec)
+                vecs[key] = vec
+            self.cache.flush()
+
+        return np.stack([vecs[key] for key in keys])
+
+
+def _band_side(scores, correct, max_error):
+    """Return the lowest threshold such that at most max_error of the scores
+    at or above it are not correct, and the fraction that are (None, None if
+    no threshold qualifies). Thresholds are put midway between distinct
+    scores."""
+    order = np.argsort(-scores, kind='stable')
+    scores = scores[order]
+    num_correct = np.cumsum(correct[order])
+    for k in range(len(scores), 0, -1):
+        # a threshold cannot split tied scores
+        if k < len(scores) and scores[k - 1] == scores[k]:
+            continue
+        if num_correct[k - 1] >= (1.0 - max_error) * k:
+            if k == len(scores):
+                threshold = float(scores[-1])
+            else:
+                threshold = float((scores[k - 1] + scores[k]) / 2)
+            return threshold, float(num_correct[k - 1] / k)
+    return None, None
+
+
+class BiEncoderScorer:
+    """Score candidate pairs by the cosine similarity of the embeddings of
+    their entities. Pairs with a similarity at or above the high end of the
+    band are predicted as matches, pairs at or below the low end as
+    non-matches, and the others are left to the cross-encoder.
+
+    The encoder of a DittoModel is not trained for similarity, so the band is
+    calibrated on labeled pairs (see calibrate). Without a band, every pair
+    is left to the cross-encoder.
+
+    Args:
+        encoder (EntityEncoder): the entity encoder
+        band (Dictionary, optional): a band returned by calibrate
+    """
+
+    def __init__(self, encoder, band=None):
+        self.encoder = encoder
+        self.band = band
+
+    def score(self, rows):
+        """Return the cosine similarity of a list of (left, right) rows"""
+        if len(rows) == 0:
+            return np.zeros(0, dtype=np.float32)
+        left = self.encoder.encode([row[0] for row in rows])
+        right = self.encoder.encode([row[1] for row in rows])
+        return np.sum(left * right, axis=1)
+
+    def calibrate(self, rows, labels, max_error=0.01):
+        """Set the widest band whose predictions are wrong on at most
+        max_error of the labeled pairs of each side.
+
+        Args:
+            rows (list): the (left, right) rows (e.g., of the validation set)
+            labels (list of int): the labels of the rows
+            max_error (float, optional): the max error rate of each side
+
+        Returns:
+            Dictionary: the band, with the low and high ends (None if no
+                threshold reaches max_error on that side) and the fraction of
+                the pairs of each side predicted correctly
+        """
+        sims = self.score(rows).astype(np.float64)
+        labels = np.asarray(labels)
+        high, high_precision = _band_side(sims, labels == 1, max_error)
+
+        # the non-matches are taken below the matches
+        below = np.ones(len(sims), dtype=bool) if high is None else sims < high
+        low, low_precision = _band_side(-sims[below], labels[below] == 0, max_error)
+        if low is not None:
+            low = -low
+
+        self.band = {'low': low, 'high': high,
+                     'low_precision': low_precision,
+                     'high_precision': high_precision}
+        return self.band
+
+    def enabled(self):
+        """Whether the band predicts any pair"""
+        return self.band is not None and \
+            (self.band['low'] is not None or self.band['high'] is not None)
+
+    def decide(self, rows):
+        """Predict the pairs the bi-encoder is confident about.
+
+        Args:
+            rows (list): the (left, right) rows
+
+        Returns:
+            list: the prediction of every row (None if borderline)
+            list of float: the confidence of every prediction, i.e., the
+                fraction of the calibration pairs on the same side of the band
+                that were predicted correctly (None if borderline)
+        """
+        predictions = [None] * len(rows)
+        confidences = [None] * len(rows)
+        if not self.enabled():
+            return predictions, confidences
+
+        low, high = self.band['low'], self.band['high']
+        for i, sim in enumerate(self.score(rows)):
+            if high is not None and sim >= high:
+                predictions[i] = 1
+                confidences[i] = self.band['high_precision']
+            elif low is not None and sim <= low:
+                predictions[i] = 0
+                confidences[i] = self.band['low_precision']
+        return predictions, confidences
@@ -0,0 +1,173 @@
+import argparse
+import json
+import os
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+from torch.utils import data
+
+from .dataset import DittoDataset, BucketBatchSampler
+from .ditto import DittoModel, evaluate, mean_pooling, saved_mask_padding
+
+try:
+    import onnxruntime
+    onnxruntimeExists = True
+except ImportError:
+    onnxruntimeExists = False
+
+
+class DittoInference(nn.Module):
+    """The inference graph of a DittoModel: the encoder, mean_pooling,
+    the normalization and the classifier, in fp32.
+
+    Args:
+        model (DittoModel): the trained model
+    """
+
+    def __init__(self, model):
+        super().__init__()
+        self.bert = model.bert.float()
+        self.fc = model.fc.float()
+        self.mask_padding = model.mask_padding
+
+    def forward(self, input_ids, attention_mask):
+        if self.mask_padding:
+            enc = self.bert(input_ids, attention_mask=attention_mask, return_dict=False)[0]
+        else:
+            enc = self.bert(input_ids, return_dict=False)[0]
+        enc = mean_pooling(enc, attention_mask)
+        enc = F.normalize(enc, p=2, dim=1)
+        return self.fc(enc)
+
+
+class ExportedModel:
+    """An exported TorchScript (.ts) or ONNX (.onnx) model with the
+    inference interface of DittoModel, i.e., model(x, x_mask) returns logits.
+
+    Args:
+        path (str): the path of the artifact
+    """
+
+    device = 'cpu'
+
+    def __init__(self, path):
+        self.path = path
+        if path.endswith('.onnx'):
+            if not onnxruntimeExists:
+                raise ImportError('onnxruntime is required to load %s' % path)
+            self.session = onnxruntime.InferenceSession(path, providers=['CPUExecutionProvider'])
+            self.module = None
+        else:
+            self.session = None
+            self.module = torch.jit.load(path, map_location='cpu')
+            self.module.eval()
+
+    def __call__(self, x, x_mask, x2=None, x2_mask=None):
+        if self.session is not None:
+            logits = self.session.run(['logits'], {'input_ids': x.numpy(),
+                                                   'attention_mask': x_mask.numpy()})[0]
+            return torch.from_numpy(logits)
+        with torch.no_grad():
+            return self.module(x, x_mask)
+
+    def eval(self):
+        return self
+
+    def share_memory(self):
+        if self.module is not None:
+            self.module.share_memory()
+        return self
+
+
+def artifact_name(fmt, quantize):
+    """Return the file name of an exported artifact"""
+    ext = {'torchscript': 'ts', 'onnx': 'onnx'}[fmt]
+    return 'model.int8.%s' % ext if quantize else 'model.%s' % ext
+
+
+def export(model, path, fmt='torchscript', quantize=False, max_len=256):
+    """Export a trained DittoModel for CPU inference.
+
+    Args:
+        model (DittoModel): the trained model
+        path (str): the output path
+        fmt (str, optional): 'torchscript' or 'onnx'
+        quantize (bool, optional): whether to apply dynamic int8 quantization
+            to the linear layers
+        max_len (int, optional): the max sequence length
+
+    Returns:
+        None
+    """
+    graph = DittoInference(model.cpu()).eval()
+    dummy = (torch.ones(2, min(max_len, 16), dtype=torch.long),
+             torch.ones(2, min(max_len, 16), dtype=torch.long))
+
+    if fmt == 'torchscript':
+        if quantize:
+            graph = torch.quantization.quantize_dynamic(graph, {nn.Linear}, dtype=torch.qint8)
+        with torch.no_grad():
+            traced = torch.jit.trace(graph, dummy, strict=False)
+        traced.save(path)
+    else:
+        fp32_path = path.replace('.int8', '') if quantize else path
+        torch.onnx.export(graph, dummy, fp32_path,
+                          input_names=['input_ids', 'attention_mask'],
+                          output_names=['logits'],
+                          dynamic_axes={'input_ids': {0: 'batch', 1: 'seq'},
+                                        'attention_mask': {0: 'batch', 1: 'seq'},
+                                        'logits': {0: 'batch'}},
+                          opset_version=14)
+        if quantize:
+            import onnx
+            from onnxruntime.quantization import quantize_dynamic, QuantType
+            # drop the traced intermediate shapes, which are specific to the
+            # dummy input and fail the shape inference of the quantizer
+            onnx_model = onnx.load(fp32_path)
+            del onnx_model.graph.value_info[:]
+            onnx.save(onnx_model, fp32_path)
+            quantize_dynamic(fp32_path, path, weight_type=QuantType.QInt8)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--task", type=str, default='Structured/Beer')
+    parser.add_argument("--lm", type=str, default='distilbert')
+    parser.add_argument("--checkpoint_path", type=str, default='checkpoints/')
+    parser.add_argument("--format", type=str, default='torchscript', choices=['torchscript', 'onnx'])
+    parser.add_argument("--quantize", dest="quantize", action="store_true")
+    parser.add_argument("--max_len", type=int, default=256)
+    parser.add_argument("--batch_size", type=int, default=64)
+    hp = parser.parse_args()
+
+    # load the fp32 model
+    directory = os.path.join(hp.checkpoint_path, hp.task)
+    saved_state = torch.load(os.path.join(directory, 'model.pt'),
+                             map_location=lambda storage, loc: storage)
+    model = DittoModel(device='cpu', lm=hp.lm, mask_padding=saved_mask_padding(saved_state))
+    model.load_state_dict(saved_state['model'])
+    model = model.float().eval()
+
+    out_path = os.path.join(directory, artifact_name(hp.format, hp.quantize))
+    export(model, out_path, fmt=hp.format, quantize=hp.quantize, max_len=hp.max_len)
+    print('exported', out_path)
+
+    # F1 parity on the validation set
+    configs = json.load(open('configs.json'))
+    configs = {conf['name'] : conf for conf in configs}
+    valid_dataset = DittoDataset(configs[hp.task]['validset'],
+                                 max_len=hp.max_len,
+                                 lm=hp.lm,
+                                 batch_tokenize=True)
+    sampler = BucketBatchSampler(valid_dataset.lengths(),
+                                 batch_size=hp.batch_size,
+                                 shuffle=False)
+    valid_iter = data.DataLoader(dataset=valid_dataset,
+                                 batch_sampler=sampler,
+                                 num_workers=0,
+                                 collate_fn=valid_dataset.collate_fn)
+
+    f1, th = evaluate(model, valid_iter)
+    exported_f1 = evaluate(ExportedModel(out_path), valid_iter, threshold=th)
+    print('fp32_f1 =', f1, 'exported_f1 =', exported_f1, 'diff =', exported_f1 - f1)
@@ -10,18 +10,24 @@ import re
 import time
 import argparse
 import sys
-import sklearn
+import queue
+import shutil
+import threading
 import traceback
 
+import torch.multiprocessing as mp
 from torch.utils import data
 from tqdm import tqdm
-from apex import amp
 from scipy.special import softmax
 
-from ditto_light.ditto import evaluate, DittoModel
+from ditto_light.ditto import evaluate, DittoModel, saved_mask_padding
 from ditto_light.exceptions import ModelNotFoundError
-from ditto_light.dataset import DittoDataset
+from ditto_light.export import ExportedModel
+from ditto_light.precision import Precision, precisions, autocast
+from ditto_light.dataset import DittoDataset, BucketBatchSampler, get_tokenizer, tokenize_pairs
 from ditto_light.summarize import Summarizer
+from ditto_light.embedding import serialize, EmbeddingCache, EntityEncoder, BiEncoderScorer
+from ditto_light.blocking import read_table, ann_candidates, token_candidates, TokenBlocker, MinHashLSH
 from ditto_light.knowledge import *
 
 
@@ -50,11 +56,7 @@ def to_str(ent1, ent2, summarizer=None, max_len=256, dk_injector=None):
     """
     content = ''
     for ent in [ent1, ent2]:
-        if isinstance(ent, str):
-            content += ent
-        else:
-            for attr in ent.keys():
-                content += 'COL %s VAL %s ' % (attr, ent[attr])
+        content += serialize(ent)
         content += '\t'
 
     content += '0'
@@ -70,6 +72,108 @@ def to_str(ent1, ent2, summarizer=None, max_len=256, dk_injector=None):
     return new_ent1 + '\t' + new_ent2 + '\t0'
 
 
+class MatcherEngine:
+    """A long-lived inference engine for matching serialized pairs.
+
+    The engine loads the tokenizer once and runs the model over
+    micro-batches, so the time per pair and the peak memory do not
+    depend on the number of pairs.
+
+    Args:
+        model (DittoModel): the model
+        lm (str, optional): the language model of the tokenizer
+        max_len (int, optional): the max sequence length
+        batch_size (int, optional): the micro-batch size of the model
+        threshold (float, optional): the threshold of the 0's class
+    """
+
+    def __init__(self, model,
+                 lm='distilbert',
+                 max_len=256,
+                 batch_size=64,
+                 threshold=None):
+        self.model = model
+        self.tokenizer = get_tokenizer(lm)
+        self.max_len = max_len
+        self.batch_size = batch_size
+        self.threshold = 0.5 if threshold is None else threshold
+
+    def prepare(self, sentence_pairs):
+        """Tokenize a list of serialized pairs into micro-batches.
+
+        The pairs are sorted by length so that each micro-batch is padded
+        to a similar length.
+
+        Args:
+            sentence_pairs (list of str): the serialized pairs
+
+        Returns:
+            list of tuple: the input indices, token ID's and mask of each micro-batch
+        """
+        order = sorted(range(len(sentence_pairs)), key=lambda i: len(sentence_pairs[i]))
+        batches = []
+        for start in range(0, len(order), self.batch_size):
+            batch = order[start:start+self.batch_size]
+            pairs = [sentence_pairs[i].split('\t')[:2] for i in batch]
+            x, mask = tokenize_pairs(self.tokenizer, pairs, self.max_len)
+            batches.append((batch, x, mask))
+        return batches
+
+    def infer(self, batches):
+        """Run the model over prepared micro-batches.
+
+        Args:
+            batches (list of tuple): the output of MatcherEngine.prepare
+
+        Returns:
+            list of int: the predictions of the pairs, in input order
+            list of list of float: the logits of the pairs, in input order
+        """
+        all_logits = [None] * sum(len(batch) for batch, _, _ in batches)
+        with torch.no_grad():
+            for batch, x, mask in batches:
+                with autocast(self.model):
+                    logits = self.model(x, mask).float().cpu().numpy()
+                for i, row in zip(batch, logits):
+                    all_logits[i] = row.tolist()
+
+        probs = softmax(np.array(all_logits).reshape(-1, 2), axis=1)[:, 1]
+        pred = [1 if p > self.threshold else 0 for p in probs]
+        return pred, all_logits
+
+    def classify(self, sentence_pairs):
+        """Classify a list of serialized pairs.
+
+        Args:
+            sentence_pairs (list of str): the serialized pairs
+
+        Returns:
+            list of int: the predictions of the pairs
+            list of list of float: the logits of the pairs
+        """
+        return self.infer(self.prepare(sentence_pairs))
+
+    def predict_pairs(self, sentence_pairs):
+        """Stream the predictions over an iterable of serialized pairs.
+
+        Args:
+            sentence_pairs (iterable of str): the serialized pairs
+
+        Yields:
+            int: the prediction of a pair
+            list of float: the logits of the pair
+        """
+        batch = []
+        for pair in sentence_pairs:
+            batch.append(pair)
+            if len(batch) == self.batch_size:
+                yield from zip(*self.classify(batch))
+                batch = []
+
+        if len(batch) > 0:
+            yield from zip(*self.classify(batch))
+
+
 def classify(sentence_pairs, model,
              lm='distilbert',
              max_len=256,
@@ -85,35 +189,275 @@ def classify(sentence_pairs, model,
     Returns:
         list of float: the scores of the pairs
     """
-    inputs = sentence_pairs
-    # print('max_len =', max_len)
-    dataset = DittoDataset(inputs,
-                           max_len=max_len,
-                           lm=lm)
-    # print(dataset[0])
-    iterator = data.DataLoader(dataset=dataset,
-                               batch_size=len(dataset),
-                               shuffle=False,
-                               num_workers=0,
-                               collate_fn=DittoDataset.pad)
-
-    # prediction
-    all_probs = []
-    all_logits = []
-    with torch.no_grad():
-        # print('Classification')
-        for i, batch in enumerate(iterator):
-            x, mask, _ = batch
-            logits = model(x,mask)
-            probs = logits.softmax(dim=1)[:, 1]
-            all_probs += probs.cpu().numpy().tolist()
-            all_logits += logits.cpu().numpy().tolist()
-
-    if threshold is None:
-        threshold = 0.5
-
-    pred = [1 if p > threshold else 0 for p in all_probs]
-    return pred, all_logits
+    engine = MatcherEngine(model, lm=lm, max_len=max_len, threshold=threshold)
+    return engine.classify(sentence_pairs)
+
+def write_predictions(writer, rows, predictions, logits):
+    """Write the predictions of a batch of rows to a jsonlines writer."""
+    scores = softmax(logits, axis=1)
+    confidences = [score[int(pred)] for pred, score in zip(predictions, scores)]
+    write_outputs(writer, rows, predictions, confidences)
+
+
+def write_outputs(writer, rows, predictions, confidences):
+    """Write the predictions and their confidence to a jsonlines writer."""
+    for row, pred, confidence in zip(rows, predictions, confidences):
+        output = {'left': row[0], 'right': row[1],
+            'match': pred,
+            'match_confidence': confidence}
+        writer.write(output)
+
+
+def predict_pipelined(reader, writer, engine, serialize,
+                      batch_size=1024,
+                      queue_size=4):
+    """Run the model over a stream of rows with a 3-stage pipeline.
+
+    A producer thread serializes (to_str, summarization, dk injection) and
+    tokenizes batches of rows, the calling thread runs the model and a
+    writer thread writes the outputs. The queues between the stages are
+    bounded, so at most about 2 * queue_size + 3 batches are in memory
+    whatever the size of the input.
+
+    Args:
+        reader (iterable): the input rows
+        writer (jsonlines.Writer): the output writer
+        engine (MatcherEngine): the inference engine
+        serialize (function): maps a row to a serialized pair
+        batch_size (int, optional): the number of rows per batch
+        queue_size (int, optional): the max number of batches per queue
+
+    Returns:
+        None
+    """
+    prepared = queue.Queue(maxsize=queue_size)
+    outputs = queue.Queue(maxsize=queue_size)
+    stop = threading.Event()
+    errors = []
+
+    def produce():
+        try:
+            rows = []
+            for row in reader:
+                if stop.is_set():
+                    break
+                rows.append(row)
+                if len(rows) == batch_size:
+                    prepared.put((rows, engine.prepare([serialize(r) for r in rows])))
+                    rows = []
+            if len(rows) > 0 and not stop.is_set():
+                prepared.put((rows, engine.prepare([serialize(r) for r in rows])))
+        except Exception as e:
+            errors.append(e)
+        finally:
+            prepared.put(None)
+
+    def consume():
+        while True:
+            item = outputs.get()
+            if item is None:
+                break
+            # keep draining the queue after an error so the model never blocks
+            if len(errors) > 0:
+                continue
+            try:
+                write_predictions(writer, *item)
+            except Exception as e:
+                errors.append(e)
+                stop.set()
+
+    producer = threading.Thread(target=produce, daemon=True)
+    consumer = threading.Thread(target=consume, daemon=True)
+    producer.start()
+    consumer.start()
+    try:
+        while True:
+            item = prepared.get()
+            if item is None:
+                break
+            if len(errors) > 0:
+                continue
+            rows, batches = item
+            predictions, logits = engine.infer(batches)
+            outputs.put((rows, predictions, logits))
+    except BaseException as e:
+        # including KeyboardInterrupt, which is re-raised below
+        errors.append(e)
+    finally:
+        if len(errors) > 0:
+            # stop the producer, and drain its queue so that a put blocked
+            # on the full queue goes through
+            stop.set()
+            while producer.is_alive():
+                try:
+                    prepared.get(timeout=0.1)
+                except queue.Empty:
+                    pass
+        outputs.put(None)
+        producer.join()
+        consumer.join()
+
+    if len(errors) > 0:
+        raise errors[0]
+
+
+def predict_stream(reader, writer, engine,
+                   summarizer=None,
+                   max_len=256,
+                   dk_injector=None,
+                   batch_size=1024,
+                   pipeline=False,
+                   queue_size=4,
+                   bi_encoder=None):
+    """Run the model over a stream of candidate entry pairs
+
+    Args:
+        reader (iterable): the input rows
+        writer (jsonlines.Writer): the output writer
+        engine (MatcherEngine): the inference engine
+        summarizer (Summarizer, optional): the summarization module
+        max_len (int, optional): the max sequence length
+        dk_injector (DKInjector, optional): the domain-knowledge injector
+        batch_size (int, optional): the number of rows serialized and written at a time
+        pipeline (bool, optional): whether to overlap preprocessing, inference
+            and writing (see predict_pipelined)
+        queue_size (int, optional): the max number of batches queued between stages
+        bi_encoder (BiEncoderScorer, optional): if set, pairs are scored from
+            cached entity embeddings first and only the pairs outside of its
+            calibrated band run through the cross-encoder
+
+    Returns:
+        None
+    """
+    if pipeline:
+        if bi_encoder is not None:
+            raise ValueError('the bi-encoder mode does not support pipeline')
+        serialize = lambda row: to_str(row[0], row[1], summarizer, max_len, dk_injector)
+        predict_pipelined(reader, writer, engine, serialize,
+                          batch_size=batch_size,
+                          queue_size=queue_size)
+        return
+
+    def process_batch(rows):
+        if bi_encoder is None:
+            predictions, confidences = [None] * len(rows), [None] * len(rows)
+        else:
+            predictions, confidences = bi_encoder.decide(rows)
+
+        # run the cross-encoder over the undecided pairs
+        borderline = [i for i, pred in enumerate(predictions) if pred is None]
+        if len(borderline) > 0:
+            pairs = [to_str(rows[i][0], rows[i][1], summarizer, max_len, dk_injector)
+                     for i in borderline]
+            cross_predictions, logits = engine.classify(pairs)
+            scores = softmax(logits, axis=1)
+            for i, pred, score in zip(borderline, cross_predictions, scores):
+                predictions[i] = pred
+                confidences[i] = score[int(pred)]
+
+        write_outputs(writer, rows, predictions, confidences)
+
+    rows = []
+    for row in reader:
+        rows.append(row)
+        if len(rows) == batch_size:
+            process_batch(rows)
+            rows = []
+
+    if len(rows) > 0:
+        process_batch(rows)
+
+
+def split_byte_ranges(path, num_shards):
+    """Split a file into byte ranges that start and end on line boundaries.
+
+    Args:
+        path (str): the file path
+        num_shards (int): the number of ranges
+
+    Returns:
+        list of tuple: the (start, end) offsets of every range
+    """
+    size = os.path.getsize(path)
+    bounds = [0]
+    with open(path, 'rb') as fin:
+        for i in range(1, num_shards):
+            # move to the start of the line containing the i-th cut
+            fin.seek(max(size * i // num_shards - 1, bounds[-1]))
+            fin.readline()
+            bounds.append(max(min(fin.tell(), size), bounds[-1]))
+    bounds.append(size)
+    return list(zip(bounds[:-1], bounds[1:]))
+
+
+def read_byte_range(path, start, end):
+    """Yield the lines of a file within a byte range."""
+    with open(path, 'rb') as fin:
+        fin.seek(start)
+        pos = start
+        while pos < end:
+            line = fin.readline()
+            if not line:
+                break
+            pos += len(line)
+            yield line
+
+
+def predict_shard(input_path, shard_path, start, end, num_threads, engine, kwargs):
+    """Run predict_stream over a byte range of the input (in a worker process)"""
+    torch.set_num_threads(num_threads)
+    with jsonlines.Reader(read_byte_range(input_path, start, end)) as reader,\
+         jsonlines.open(shard_path, mode='w') as writer:
+        predict_stream(reader, writer, engine, **kwargs)
+
+
+def predict_sharded(input_path, output_path, engine, workers, **kwargs):
+    """Run the model over the input file with several worker processes.
+
+    The input is split into byte ranges, each worker writes the predictions
+    of its range into a shard file and the shards are concatenated in input
+    order. The model parameters are moved to shared memory before the workers
+    start, so the model RAM is paid once whatever the number of workers.
+
+    Args:
+        input_path (str): the input file path (jsonlines)
+        output_path (str): the output file path
+        engine (MatcherEngine): the inference engine (with a CPU model)
+        workers (int): the number of worker processes
+        kwargs: the other arguments of predict_stream
+
+    Returns:
+        None
+    """
+    # forked workers cannot use the CUDA context of the parent
+    if 'cuda' in str(getattr(engine.model, 'device', 'cpu')):
+        raise ValueError('the sharded mode (workers > 1) needs a CPU model, '
+                         'run a GPU model with workers=1')
+    engine.model.share_memory()
+    num_threads = max(1, (os.cpu_count() or 1) // workers)
+    ranges = split_byte_ranges(input_path, workers)
+    shard_paths = ['%s.shard%d' % (output_path, i) for i in range(len(ranges))]
+
+    processes = []
+    for (start, end), shard_path in zip(ranges, shard_paths):
+        p = mp.Process(target=predict_shard,
+                       args=(input_path, shard_path, start, end, num_threads, engine, kwargs))
+        p.start()
+        processes.append(p)
+
+    for p in processes:
+        p.join()
+    failed = [i for i, p in enumerate(processes) if p.exitcode != 0]
+    if len(failed) > 0:
+        raise RuntimeError('prediction failed in worker(s) %s' % failed)
+
+    # merge the shards in input order
+    with open(output_path, 'wb') as fout:
+        for shard_path in shard_paths:
+            with open(shard_path, 'rb') as fin:
+                shutil.copyfileobj(fin, fout)
+            os.remove(shard_path)
+
 
 def predict(input_path, output_path, config,
             model,
@@ -122,7 +466,14 @@ def predict(input_path, output_path, config,
             lm='distilbert',
             max_len=256,
             dk_injector=None,
-            threshold=None):
+            threshold=None,
+            engine=None,
+            micro_batch_size=64,
+            pipeline=False,
+            queue_size=4,
+            workers=1,
+            bi_encoder=None,
+            rows=None):
     """Run the model over the input file containing the candidate entry pairs
 
     Args:
@@ -130,38 +481,33 @@ def predict(input_path, output_path, config,
         output_path (str): the output file path
         config (Dictionary): task configuration
         model (DittoModel): the model for prediction
-        batch_size (int): the batch size
+        batch_size (int): the number of rows serialized and written at a time
         summarizer (Summarizer, optional): the summarization module
         max_len (int, optional): the max sequence length
         dk_injector (DKInjector, optional): the domain-knowledge injector
         threshold (float, optional): the threshold of the 0's class
+        engine (MatcherEngine, optional): the inference engine to reuse
+        micro_batch_size (int, optional): the model batch size (if engine is not set)
+        pipeline (bool, optional): whether to overlap preprocessing, inference
+            and writing (see predict_pipelined)
+        queue_size (int, optional): the max number of batches queued between stages
+        workers (int, optional): the number of worker processes (see predict_sharded)
+        bi_encoder (BiEncoderScorer, optional): the bi-encoder scoring the
+            confident pairs from cached embeddings (see predict_stream)
+        rows (iterable, optional): the candidate pairs to score instead of
+            the content of input_path (e.g., from ditto_light.blocking)
 
     Returns:
         None
     """
-    pairs = []
-
-    def process_batch(rows, pairs, writer):
-        predictions, logits = classify(pairs, model, lm=lm,
-                                       max_len=max_len,
-                                       threshold=threshold)
-        # try:
-        #     predictions, logits = classify(pairs, model, lm=lm,
-        #                                    max_len=max_len,
-        #                                    threshold=threshold)
-        # except:
-        #     # ignore the whole batch
-        #     return
-        scores = softmax(logits, axis=1)
-        for row, pred, score in zip(rows, predictions, scores):
-            output = {'left': row[0], 'right': row[1],
-                'match': pred,
-                'match_confidence': score[int(pred)]}
-            writer.write(output)
+    if engine is None:
+        engine = MatcherEngine(model, lm=lm, max_len=max_len,
+                               batch_size=micro_batch_size,
+                               threshold=threshold)
 
     # input_path can also be train/valid/test.txt
     # convert to jsonlines
-    if '.txt' in input_path:
+    if rows is None and '.txt' in input_path:
         with jsonlines.open(input_path + '.jsonl', mode='w') as writer:
             for line in open(input_path):
                 writer.write(line.split('\t')[:2])
@@ -169,37 +515,132 @@ def predict(input_path, output_path, config,
 
     # batch processing
     start_time = time.time()
-    with jsonlines.open(input_path) as reader,\
-         jsonlines.open(output_path, mode='w') as writer:
-        pairs = []
-        rows = []
-        for idx, row in tqdm(enumerate(reader)):
-            pairs.append(to_str(row[0], row[1], summarizer, max_len, dk_injector))
-            rows.append(row)
-            if len(pairs) == batch_size:
-                process_batch(rows, pairs, writer)
-                pairs.clear()
-                rows.clear()
-
-        if len(pairs) > 0:
-            process_batch(rows, pairs, writer)
+    kwargs = {'summarizer': summarizer,
+              'max_len': max_len,
+              'dk_injector': dk_injector,
+              'batch_size': batch_size,
+              'pipeline': pipeline,
+              'queue_size': queue_size,
+              'bi_encoder': bi_encoder}
+    if rows is not None:
+        # candidates streamed from a blocking stage
+        with jsonlines.open(output_path, mode='w') as writer:
+            predict_stream(tqdm(rows), writer, engine, **kwargs)
+    elif workers > 1:
+        predict_sharded(input_path, output_path, engine, workers, **kwargs)
+    else:
+        with jsonlines.open(input_path) as reader,\
+             jsonlines.open(output_path, mode='w') as writer:
+            predict_stream(tqdm(reader), writer, engine, **kwargs)
 
     run_time = time.time() - start_time
     run_tag = '%s_lm=%s_dk=%s_su=%s' % (config['name'], lm, str(dk_injector != None), str(summarizer != None))
     os.system('echo %s %f >> log.txt' % (run_tag, run_time))
 
 
-def tune_threshold(config, model, hp):
-    """Tune the prediction threshold for a given model on a validation set"""
+def threshold_path(hp):
+    """Return the path of the tuned threshold file next to model.pt"""
+    return os.path.join(hp.checkpoint_path, hp.task, 'threshold.json')
+
+
+def threshold_key(hp, model):
+    """Return the settings a tuned threshold is valid for"""
+    checkpoint = os.path.join(hp.checkpoint_path, hp.task, hp.artifact or 'model.pt')
+    return {'lm': hp.lm,
+            'mask_padding': getattr(model, 'mask_padding', None),
+            'artifact': hp.artifact,
+            'max_len': hp.max_len,
+            'summarize': hp.summarize,
+            'pair_budget': hp.pair_budget,
+            'dk': hp.dk,
+            'checkpoint_mtime': os.path.getmtime(checkpoint)}
+
+
+def load_threshold(hp, model):
+    """Load the persisted threshold if it was tuned with the same settings
+
+    Returns:
+        Dictionary: the threshold, its f1 and the band of the bi-encoder if
+            it was calibrated (None if there is no valid persisted threshold)
+    """
+    path = threshold_path(hp)
+    if not os.path.exists(path):
+        return None
+    saved = json.load(open(path))
+    if saved['key'] != threshold_key(hp, model):
+        return None
+    print("loaded threshold =", saved['threshold'], "f1 =", saved['f1'])
+    return saved
+
+
+def save_threshold(hp, model, threshold, f1, bi_band=None):
+    """Persist a tuned threshold (and the band of the bi-encoder) next to model.pt"""
+    saved = {'threshold': float(threshold),
+             'f1': float(f1),
+             'key': threshold_key(hp, model)}
+    if bi_band is not None:
+        saved['bi_encoder'] = {'max_error': hp.bi_max_error, 'band': bi_band}
+    with open(threshold_path(hp), 'w') as fout:
+        json.dump(saved, fout)
+
+
+def calibrate_bi_encoder(bi_encoder, validset, max_error):
+    """Calibrate the band of a bi-encoder on the validation set
+
+    Returns:
+        Dictionary: the band (see BiEncoderScorer.calibrate)
+    """
+    rows, labels = [], []
+    for line in open(validset):
+        s1, s2, label = line.strip().split('\t')
+        rows.append((s1, s2))
+        labels.append(int(label))
+
+    band = bi_encoder.calibrate(rows, labels, max_error=max_error)
+    if bi_encoder.enabled():
+        print("bi-encoder band =", band)
+    else:
+        print("bi-encoder calibration failed, every pair runs through the cross-encoder")
+    return band
+
+
+def tune_threshold(config, model, hp, bi_encoder=None):
+    """Tune the prediction threshold for a given model on a validation set
+
+    The threshold is taken from a single pass of the model over the
+    validation set. If bi_encoder is set, its band is calibrated on the
+    validation set too, with an error rate of at most hp.bi_max_error. If
+    hp.cache_threshold is set, the tuned threshold and band are persisted
+    next to model.pt and reused by later runs with the same settings.
+    """
+    saved = None
+    if hp.cache_threshold:
+        saved = load_threshold(hp, model)
+        if saved is not None and bi_encoder is not None:
+            if saved.get('bi_encoder', {}).get('max_error') == hp.bi_max_error:
+                bi_encoder.band = saved['bi_encoder']['band']
+            else:
+                # the threshold is valid, only the band is missing
+                band = calibrate_bi_encoder(bi_encoder, config['validset'],
+                                            hp.bi_max_error)
+                save_threshold(hp, model, saved['threshold'], saved['f1'], band)
+        if saved is not None:
+            return saved['threshold']
+
     validset = config['validset']
-    task = hp.task
+    bi_band = None
+    if bi_encoder is not None:
+        # from the raw entities, like the candidates at prediction time
+        bi_band = calibrate_bi_encoder(bi_encoder, validset, hp.bi_max_error)
 
     # summarize the sequences up to the max sequence length
     set_seed(123)
     summarizer = injector = None
     if hp.summarize:
-        summarizer = Summarizer(config, lm=hp.lm)
-        validset = summarizer.transform_file(validset, max_len=hp.max_len, overwrite=True)
+        summarizer = Summarizer(config, lm=hp.lm, cache_dir=hp.cache_dir,
+                                pair_budget=hp.pair_budget)
+        validset = summarizer.transform_file(validset, max_len=hp.max_len,
+                                             num_workers=hp.workers)
 
     if hp.dk is not None:
         if hp.dk == 'product':
@@ -212,49 +653,32 @@ def tune_threshold(config, model, hp):
     # load dev sets
     valid_dataset = DittoDataset(validset,
                                  max_len=hp.max_len,
-                                 lm=hp.lm)
+                                 lm=hp.lm,
+                                 batch_tokenize=True)
 
     # print(valid_dataset[0])
 
+    # sort the pairs by length to minimize padding
+    sampler = BucketBatchSampler(valid_dataset.lengths(),
+                                 batch_size=hp.batch_size,
+                                 shuffle=False)
     valid_iter = data.DataLoader(dataset=valid_dataset,
-                                 batch_size=64,
-                                 shuffle=False,
+                                 batch_sampler=sampler,
                                  num_workers=0,
-                                 collate_fn=DittoDataset.pad)
+                                 collate_fn=valid_dataset.collate_fn)
 
     # acc, prec, recall, f1, v_loss, th = eval_classifier(model, valid_iter,
     #                                                     get_threshold=True)
     f1, th = evaluate(model, valid_iter, threshold=None)
-
-    # verify F1
-    set_seed(123)
-    predict(validset, "tmp.jsonl", config, model,
-            summarizer=summarizer,
-            max_len=hp.max_len,
-            lm=hp.lm,
-            dk_injector=injector,
-            threshold=th)
-
-    predicts = []
-    with jsonlines.open("tmp.jsonl", mode="r") as reader:
-        for line in reader:
-            predicts.append(int(line['match']))
-    os.system("rm tmp.jsonl")
-
-    labels = []
-    with open(validset) as fin:
-        for line in fin:
-            labels.append(int(line.split('\t')[-1]))
-
-    real_f1 = sklearn.metrics.f1_score(labels, predicts)
     print("load_f1 =", f1)
-    print("real_f1 =", real_f1)
 
-    return th
+    if hp.cache_threshold:
+        save_threshold(hp, model, th, f1, bi_band)
 
+    return th
 
 
-def load_model(task, path, lm, use_gpu, fp16=True):
+def load_model(task, path, lm, use_gpu, fp16=True, artifact=None, precision=None):
     """Load a model for a specific task.
 
     Args:
@@ -262,14 +686,17 @@ def load_model(task, path, lm, use_gpu, fp16=True):
         path (str): the path of the checkpoint directory
         lm (str): the language model
         use_gpu (boolean): whether to use gpu
-        fp16 (boolean, optional): whether to use fp16
+        fp16 (boolean, optional): whether to use fp16 on GPU (if precision is not set)
+        artifact (str, optional): the file name of an exported model
+            (e.g., model.int8.ts, see ditto_light.export) to load instead of model.pt
+        precision (str, optional): fp32, bf16, fp16 or apex (see ditto_light.precision)
 
     Returns:
         Dictionary: the task config
         MultiTaskNet: the model
     """
     # load models
-    checkpoint = os.path.join(path, task, 'model.pt')
+    checkpoint = os.path.join(path, task, artifact or 'model.pt')
     if not os.path.exists(checkpoint):
         raise ModelNotFoundError(checkpoint)
 
@@ -278,19 +705,23 @@ def load_model(task, path, lm, use_gpu, fp16=True):
     config = configs[task]
     config_list = [config]
 
+    if artifact is not None:
+        model = ExportedModel(checkpoint)
+        return config, model
+
     if use_gpu:
         device = 'cuda' if torch.cuda.is_available() else 'cpu'
     else:
         device = 'cpu'
 
-    model = DittoModel(device=device, lm=lm)
-
     saved_state = torch.load(checkpoint, map_location=lambda storage, loc: storage)
+    model = DittoModel(device=device, lm=lm, mask_padding=saved_mask_padding(saved_state))
     model.load_state_dict(saved_state['model'])
     model = model.to(device)
 
-    if fp16 and 'cuda' in device:
-        model = amp.initialize(model, opt_level='O2')
+    if precision is None:
+        precision = 'fp16' if fp16 and 'cuda' in device else 'fp32'
+    model = Precision(precision, device).initialize(model)
 
     return config, model
 
@@ -303,20 +734,50 @@ if __name__ == "__main__":
     parser.add_argument("--lm", type=str, default='distilbert')
     parser.add_argument("--use_gpu", dest="use_gpu", action="store_true")
     parser.add_argument("--fp16", dest="fp16", action="store_true")
+    parser.add_argument("--precision", type=str, default=None, choices=precisions)
     parser.add_argument("--checkpoint_path", type=str, default='checkpoints/')
     parser.add_argument("--dk", type=str, default=None)
     parser.add_argument("--summarize", dest="summarize", action="store_true")
     parser.add_argument("--max_len", type=int, default=256)
+    parser.add_argument("--batch_size", type=int, default=64)
+    parser.add_argument("--pipeline", dest="pipeline", action="store_true")
+    parser.add_argument("--queue_size", type=int, default=4)
+    parser.add_argument("--workers", type=int, default=1)
+    parser.add_argument("--cache_threshold", dest="cache_threshold", action="store_true")
+    parser.add_argument("--artifact", type=str, default=None)
+    parser.add_argument("--bi_encoder", dest="bi_encoder", action="store_true")
+    parser.add_argument("--bi_max_error", type=float, default=0.01)
+    parser.add_argument("--embedding_cache", type=str, default=None)
+    parser.add_argument("--cache_dir", type=str, default=None)
+    parser.add_argument("--pair_budget", dest="pair_budget", action="store_true")
+    parser.add_argument("--left_table", type=str, default=None)
+    parser.add_argument("--right_table", type=str, default=None)
+    parser.add_argument("--topk", type=int, default=10)
+    parser.add_argument("--blocker", type=str, default='ann', choices=['ann', 'token', 'minhash'])
+    parser.add_argument("--block_attrs", type=str, default=None)
     hp = parser.parse_args()
+    if hp.workers > 1 and hp.use_gpu:
+        parser.error('--workers > 1 runs on CPU, it cannot be used with --use_gpu')
+    if hp.artifact is not None and (hp.bi_encoder or
+                                    (hp.left_table is not None and hp.blocker == 'ann')):
+        # an exported model only has the pair classifier, not DittoModel.encode
+        parser.error('--bi_encoder and the ann blocker need model.pt, not --artifact')
+    if hp.left_table is not None and hp.workers > 1:
+        # the candidates are streamed from the blocker, not sharded by file
+        parser.error('--workers > 1 shards --input_path, it cannot be used with --left_table')
+    if hp.bi_encoder and hp.pipeline:
+        parser.error('--bi_encoder cannot be used with --pipeline')
 
     # load the models
     set_seed(123)
     config, model = load_model(hp.task, hp.checkpoint_path,
-                       hp.lm, hp.use_gpu, hp.fp16)
+                       hp.lm, hp.use_gpu, hp.fp16, artifact=hp.artifact,
+                       precision=hp.precision)
 
     summarizer = dk_injector = None
     if hp.summarize:
-        summarizer = Summarizer(config, hp.lm)
+        summarizer = Summarizer(config, hp.lm, cache_dir=hp.cache_dir,
+                                pair_budget=hp.pair_budget)
 
     if hp.dk is not None:
         if 'product' in hp.dk:
@@ -324,8 +785,44 @@ if __name__ == "__main__":
         else:
             dk_injector = GeneralDKInjector(config, hp.dk)
 
+    encoder = None
+    if hp.bi_encoder or (hp.left_table is not None and hp.blocker == 'ann'):
+        # a retrained checkpoint at the same path gets new embeddings
+        checkpoint = os.path.join(hp.checkpoint_path, hp.task, 'model.pt')
+        namespace = '%s_lm=%s_max_len=%d_mtime=%f_mask=%d' % (os.path.join(hp.checkpoint_path, hp.task),
+                                                              hp.lm, hp.max_len,
+                                                              os.path.getmtime(checkpoint),
+                                                              model.mask_padding)
+        cache = EmbeddingCache(path=hp.embedding_cache, namespace=namespace)
+        encoder = EntityEncoder(model, lm=hp.lm, max_len=hp.max_len,
+                                batch_size=hp.batch_size,
+                                cache=cache,
+                                dk_injector=dk_injector)
+
+    # score the confident pairs from cached entity embeddings (the band is
+    # calibrated with the threshold)
+    bi_encoder = None
+    if hp.bi_encoder:
+        bi_encoder = BiEncoderScorer(encoder)
+
+    # generate the candidates from two tables instead of reading input_path
+    rows = None
+    if hp.left_table is not None:
+        left_records = read_table(hp.left_table)
+        right_records = read_table(hp.right_table)
+        if hp.blocker == 'ann':
+            rows = ann_candidates(left_records, right_records, encoder, k=hp.topk)
+        else:
+            attrs = hp.block_attrs.split(',') if hp.block_attrs else None
+            if hp.blocker == 'token':
+                blocker = TokenBlocker(attrs=attrs)
+            else:
+                blocker = MinHashLSH(attrs=attrs)
+            rows = token_candidates(left_records, right_records, blocker,
+                                    max_candidates=hp.topk)
+
     # tune threshold
-    threshold = tune_threshold(config, model, hp)
+    threshold = tune_threshold(config, model, hp, bi_encoder=bi_encoder)
 
     # run prediction
     predict(hp.input_path, hp.output_path, config, model,
@@ -333,4 +830,13 @@ if __name__ == "__main__":
             max_len=hp.max_len,
             lm=hp.lm,
             dk_injector=dk_injector,
-            threshold=threshold)
+            threshold=threshold,
+            micro_batch_size=hp.batch_size,
+            pipeline=hp.pipeline,
+            queue_size=hp.queue_size,
+            workers=hp.workers,
+            bi_encoder=bi_encoder,
+            rows=rows)
+
+    if summarizer is not None:
+        summarizer.save_len_cache()
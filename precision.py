@@ -0,0 +1,118 @@
+import contextlib
+import warnings
+import torch
+
+try:
+    from apex import amp
+    apexExists = True
+except ImportError:
+    apexExists = False
+
+precisions = ['fp32', 'bf16', 'fp16', 'apex']
+
+
+def resolve_precision(hp):
+    """Return the precision of a run: hp.precision if set, otherwise fp16
+    (native AMP) if hp.fp16 is set and fp32 if not.
+    """
+    precision = getattr(hp, 'precision', None)
+    if precision is None:
+        precision = 'fp16' if getattr(hp, 'fp16', False) else 'fp32'
+    return precision
+
+
+class Precision:
+    """The numerical precision of training and inference.
+
+    - fp32: full precision
+    - bf16: bfloat16 autocast, on CPU or GPU (no loss scaling needed)
+    - fp16: float16 autocast with a GradScaler (native AMP, GPU only; falls
+      back to bf16 on CPU)
+    - apex: apex AMP with opt_level O2 (GPU only, needs apex)
+
+    Args:
+        precision (str, optional): one of fp32, bf16, fp16 or apex
+        device (str, optional): the device of the model
+    """
+
+    def __init__(self, precision='fp32', device='cpu'):
+        if precision not in precisions:
+            raise ValueError('unknown precision %s (expected one of %s)' %
+                             (precision, ', '.join(precisions)))
+        self.device_type = 'cuda' if 'cuda' in str(device) else 'cpu'
+        if precision in ['fp16', 'apex'] and self.device_type == 'cpu':
+            warnings.warn('%s needs a GPU, using bf16 on CPU' % precision)
+            precision = 'bf16'
+        if precision == 'apex' and not apexExists:
+            raise ImportError('apex is required for precision=apex')
+        self.precision = precision
+
+        self.scaler = None
+        if precision == 'fp16':
+            self.scaler = torch.amp.GradScaler('cuda')
+
+    def autocast(self):
+        """Return the autocast context of the forward passes"""
+        if self.precision == 'bf16':
+            return torch.autocast(device_type=self.device_type, dtype=torch.bfloat16)
+        if self.precision == 'fp16':
+            return torch.autocast(device_type=self.device_type, dtype=torch.float16)
+        return contextlib.nullcontext()
+
+    def initialize(self, model, optimizer=None):
+        """Prepare a model (and its optimizer) for this precision.
+
+        Args:
+            model (DittoModel): the model (already on its device)
+            optimizer (Optimizer, optional): the optimizer
+
+        Returns:
+            DittoModel: the model, with the precision attached as model.precision
+            Optimizer: the optimizer (if given)
+        """
+        if self.precision == 'apex':
+            if optimizer is None:
+                model = amp.initialize(model, opt_level='O2')
+            else:
+                model, optimizer = amp.initialize(model, optimizer, opt_level='O2')
+        model.precision = self
+        if optimizer is None:
+            return model
+        return model, optimizer
+
+    def backward(self, loss, optimizer):
+        """Backpropagate a loss (scaled if needed)"""
+        if self.scaler is not None:
+            self.scaler.scale(loss).backward()
+        elif self.precision == 'apex':
+            with amp.scale_loss(loss, optimizer) as scaled_loss:
+                scaled_loss.backward()
+        else:
+            loss.backward()
+
+    def step(self, optimizer):
+        """Run an optimizer step (skipped by the GradScaler on inf/nan gradients)"""
+        if self.scaler is not None:
+            self.scaler.step(optimizer)
+            self.scaler.update()
+        else:
+            optimizer.step()
+
+    def state_dict(self):
+        """Return the state of the GradScaler (empty if there is none)"""
+        return {} if self.scaler is None else self.scaler.state_dict()
+
+    def load_state_dict(self, state):
+        """Restore the state of the GradScaler"""
+        if self.scaler is not None and len(state) > 0:
+            self.scaler.load_state_dict(state)
+
+
+def autocast(model):
+    """Return the autocast context of the precision attached to a model
+    (see Precision.initialize); fp32 if there is none.
+    """
+    precision = getattr(model, 'precision', None)
+    if precision is None:
+        return contextlib.nullcontext()
+    return precision.autocast()
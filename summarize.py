@@ -1,19 +1,69 @@
 # Implementation from https://dev.to/davidisrawi/build-a-quick-summarizer-with-python-and-nltk
 
    
+import functools
+import hashlib
+import itertools
+import json
+import multiprocessing
 import numpy as np
 import os
+from collections import OrderedDict
+from multiprocessing import util
 from nltk.corpus import stopwords
 from nltk.stem import PorterStemmer
 from nltk.tokenize import word_tokenize, sent_tokenize
 
 from .dataset import get_tokenizer
 
+_stop_words = None
+_stemmer = None
+
+
+def get_stop_words():
+    """Return the set of English stopwords (loaded once per process)"""
+    global _stop_words
+    if _stop_words is None:
+        _stop_words = set(stopwords.words("english"))
+    return _stop_words
+
+
+@functools.lru_cache(maxsize=100000)
+def stem(word):
+    """Return the Porter stem of a word (memoized, with one shared stemmer)"""
+    global _stemmer
+    if _stemmer is None:
+        _stemmer = PorterStemmer()
+    return _stemmer.stem(word)
+
+
 class Summarizer:
-    def __init__(self, task_config, lm):
+    """Summarize the entity pairs of a task up to a max sequence length.
+
+    Args:
+        task_config (Dictionary): the task configuration
+        lm (str): the language model of the tokenizer
+        cache_dir (str, optional): the directory of the persistent subword-length cache
+            (one file per tokenizer; in memory only if not set)
+        len_cache_size (int, optional): the max number of words in the length cache
+        pair_budget (bool, optional): if true, fit the pair of summaries jointly in
+            max_len (including the special tokens) instead of each entity separately
+    """
+
+    def __init__(self, task_config, lm, cache_dir=None, len_cache_size=1000000,
+                 pair_budget=False):
         self.config = task_config
+        self.lm = lm
+        self.pair_budget = pair_budget
         self.tokenizer = get_tokenizer(lm=lm)
-        self.len_cache = {}
+        self.cache_dir = cache_dir
+        self.len_cache_size = len_cache_size
+        self.len_cache = OrderedDict()
+        self.len_cache_path = None
+        if cache_dir is not None:
+            name = hashlib.sha1(lm.encode('utf-8')).hexdigest()[:16]
+            self.len_cache_path = os.path.join(cache_dir, 'len_cache.%s.json' % name)
+            self.len_cache.update(self._read_len_cache())
 
     def _create_frequency_table(self, text_string) -> dict:
         """
@@ -23,13 +73,12 @@ class Summarizer:
         Stemmer - an algorithm to bring words to its root word.
         :rtype: dict
         """
-        stopWords = set(stopwords.words("english"))
+        stopWords = get_stop_words()
         words = word_tokenize(text_string)
-        ps = PorterStemmer()
 
         freqTable = dict()
         for word in words:
-            word = ps.stem(word)
+            word = stem(word)
             if word in stopWords:
                 continue
             if word in freqTable:
@@ -44,24 +93,45 @@ class Summarizer:
         """
         score a sentence by its words
         Basic algorithm: adding the frequency of every non-stop word in a sentence divided by total no of words in a sentence.
+        A word is scored by the frequency table entries that are substrings of it. Instead of
+        testing every entry against every word in Python, the distinct lowercased words are
+        joined into one string and every entry is located with str.find. The scan is still
+        O(len(freqTable) * len(text)), but it runs in C, and the Python-level work is one
+        step per entry and per match.
         :rtype: dict
         """
+        words = list(dict.fromkeys(sents))
+        # lowercasing can change the length of a word (e.g., 'İ' becomes 2 code points)
+        lowered = [word.lower() for word in words]
+        text = '\n'.join(lowered)
+        # the index of the word of every character (a separator belongs to the word before it)
+        owner = []
+        for idx, word in enumerate(lowered):
+            owner.extend([idx] * (len(word) + 1))
+
+        # the frequencies of the entries matching every word, in table order
+        matches = [[] for _ in words]
+        for wordValue, freq in freqTable.items():
+            last = -1
+            pos = text.find(wordValue)
+            while pos >= 0:
+                if owner[pos] != last:
+                    last = owner[pos]
+                    matches[last].append(freq)
+                pos = text.find(wordValue, pos + 1)
+        matches = dict(zip(words, matches))
 
         sentenceValue = dict()
 
         for word in sents:
-            # word_count_in_sentence = (len(word_tokenize(word)))
-            word_count_in_sentence_except_stop_words = 0
-            for wordValue in freqTable:
-                if wordValue in word.lower():
-                    word_count_in_sentence_except_stop_words += 1
-                    if word in sentenceValue:
-                        sentenceValue[word] += freqTable[wordValue]
-                    else:
-                        sentenceValue[word] = freqTable[wordValue]
-
-            if word in sentenceValue:
-                sentenceValue[word] = sentenceValue[word] / word_count_in_sentence_except_stop_words
+            freqs = matches[word]
+            if len(freqs) == 0:
+                continue
+            # a repeated word adds to its previous score before the division
+            value = sentenceValue.get(word, 0)
+            for freq in freqs:
+                value += freq
+            sentenceValue[word] = value / len(freqs)
 
         return sentenceValue
 
@@ -83,25 +153,67 @@ class Summarizer:
     def get_len(self, word):
         """Return the sentence_piece length of a token.
         """
-        if word in self.len_cache:
-            return self.len_cache[word]
-        length = len(self.tokenizer.tokenize(word))
-        self.len_cache[word] = length
-        return length
+        return self.get_lens([word])[0]
+
+    def get_lens(self, words):
+        """Return the sentence_piece lengths of a list of tokens. The tokens missing
+        from the cache are tokenized with one call to the tokenizer.
+        """
+        missing = [word for word in dict.fromkeys(words) if word not in self.len_cache]
+        if len(missing) > 0:
+            input_ids = self.tokenizer(missing, add_special_tokens=False)['input_ids']
+            for word, ids in zip(missing, input_ids):
+                self.len_cache[word] = len(ids)
+
+        lengths = []
+        for word in words:
+            self.len_cache.move_to_end(word)
+            lengths.append(self.len_cache[word])
+        while len(self.len_cache) > self.len_cache_size:
+            self.len_cache.popitem(last=False)
+        return lengths
+
+    def _read_len_cache(self):
+        """Return the (word, length) pairs of the on-disk cache, least recently used first"""
+        if self.len_cache_path is None or not os.path.exists(self.len_cache_path):
+            return []
+        with open(self.len_cache_path) as fin:
+            return json.load(fin)
+
+    def save_len_cache(self):
+        """Merge the length cache into its on-disk file, keeping the len_cache_size
+        most recently used words.
+        """
+        if self.len_cache_path is None:
+            return
+        merged = OrderedDict(self._read_len_cache())
+        for word, length in self.len_cache.items():
+            merged[word] = length
+            merged.move_to_end(word)
+        while len(merged) > self.len_cache_size:
+            merged.popitem(last=False)
+
+        os.makedirs(self.cache_dir, exist_ok=True)
+        # concurrent writers may drop each other's new words, which only costs
+        # recomputing them
+        tmp_path = '%s.%d.tmp' % (self.len_cache_path, os.getpid())
+        with open(tmp_path, 'w') as fout:
+            json.dump(list(merged.items()), fout)
+        os.replace(tmp_path, self.len_cache_path)
 
     def _generate_summary(self, freq_table, words, label, sentenceValue, threshold, max_len):
         summary = ''
         total_len = 0
 
-        for word in words:
+        for word, length in zip(words, self.get_lens(words)):
             if word in ['COL', 'VAL']:
               summary += word + ' '
             elif word in sentenceValue and sentenceValue[word] <= (5*threshold):
               summary += word + " "
 
-            if self.get_len(word) + total_len > max_len:
+            if length + total_len > max_len:
               break
-            total_len += self.get_len(word)
+            total_len += length
 
         if summary == "":
           for word in words:
@@ -110,6 +222,67 @@ class Summarizer:
         return summary
 
 
+    def _generate_pair_summary(self, entity_A, entity_B, max_len):
+        """Summarize both entities of a pair so that the tokenized pair fits in max_len.
+
+        Every entity keeps the same words as in _generate_summary. If the pair is too
+        long, the token budget (max_len minus the special tokens) is split between the
+        entities by their information score, the sum of the inverse scores of the kept
+        words (rare words carry more information), and every entity is cut to its share.
+        A budget share one entity does not need goes to the other.
+
+        Args:
+            entity_A (tuple): the words, word scores and threshold of the 1st entity
+            entity_B (tuple): the words, word scores and threshold of the 2nd entity
+            max_len (int): the max sequence length of the pair
+
+        Returns:
+            str: the summary of the 1st entity
+            str: the summary of the 2nd entity
+        """
+        budget = max_len - self.tokenizer.num_special_tokens_to_add(pair=True)
+        kept, lengths, info = [], [], []
+        for words, sentenceValue, threshold in [entity_A, entity_B]:
+            words_kept = [word for word in words if word in ['COL', 'VAL'] or \
+                          (word in sentenceValue and sentenceValue[word] <= (5*threshold))]
+            if len(words_kept) == 0:
+                words_kept = words
+            kept.append(words_kept)
+            lengths.append(self.get_lens(words_kept))
+            info.append(sum(1.0 / sentenceValue[word] for word in words_kept
+                            if sentenceValue.get(word, 0) > 0))
+
+        total_A, total_B = sum(lengths[0]), sum(lengths[1])
+        if total_A + total_B <= budget:
+            budgets = [total_A, total_B]
+        else:
+            share = 0.5 if info[0] + info[1] == 0 else info[0] / (info[0] + info[1])
+            budget_A = min(total_A, max(budget - total_B, int(round(budget * share))))
+            budgets = [budget_A, budget - budget_A]
+
+        summaries = []
+        for words, word_lens, side_budget in zip(kept, lengths, budgets):
+            total_len = 0
+            summary = []
+            for word, length in zip(words, word_lens):
+                if length + total_len > side_budget:
+                    break
+                summary.append(word)
+                total_len += length
+            summaries.append(summary)
+
+        # the subwords of a word in context can differ from those of the word alone,
+        # so check the tokenized pair and drop words from the end of the longer entity
+        while len(summaries[0]) + len(summaries[1]) > 0:
+            length = len(self.tokenizer(' '.join(summaries[0]), ' '.join(summaries[1]))['input_ids'])
+            if length <= max_len:
+                break
+            longer = 0 if len(summaries[0]) >= len(summaries[1]) else 1
+            summaries[longer].pop()
+
+        return [''.join(word + ' ' for word in summary) for summary in summaries]
+
+
     def transform(self, row, max_len):
 
         sentA, sentB, label = row.strip().split('\t')
@@ -123,6 +296,9 @@ class Summarizer:
         word_sent_A = word_tokenize(sentA) 
         word_sent_B = word_tokenize(sentB) 
 
+        # the subword lengths of both entities in one tokenizer call
+        self.get_lens(word_sent_A + word_sent_B)
+
         # 3 Important Algorithm: score the sentences
         sentence_scores_A = self._score_sentences(word_sent_A, freq_table_A)
         sentence_scores_B = self._score_sentences(word_sent_B, freq_table_B)
@@ -132,26 +308,121 @@ class Summarizer:
         threshold_B = self._find_average_score(sentence_scores_B)
 
         # 5 Important Algorithm: Generate the summary
-        summary_A = self._generate_summary(freq_table_A, word_sent_A, label, sentence_scores_A, threshold_A, max_len)
-        summary_B = self._generate_summary(freq_table_B, word_sent_B, label, sentence_scores_B, threshold_B, max_len)
+        if self.pair_budget:
+            summary_A, summary_B = self._generate_pair_summary(
+                (word_sent_A, sentence_scores_A, threshold_A),
+                (word_sent_B, sentence_scores_B, threshold_B), max_len)
+        else:
+            summary_A = self._generate_summary(freq_table_A, word_sent_A, label, sentence_scores_A, threshold_A, max_len)
+            summary_B = self._generate_summary(freq_table_B, word_sent_B, label, sentence_scores_B, threshold_B, max_len)
 
         summary = summary_A + "\t" + summary_B + "\t" + label + "\n"
+        return summary
 
 
-    def transform_file(self, input_fn, max_len, overwrite=False):
+    def cache_key(self, input_fn, max_len):
+        """Return the key of the summarized output of a file: the hash of its
+        content, max_len, the tokenizer and the budget mode.
+        """
+        sha = hashlib.sha1()
+        with open(input_fn, 'rb') as fin:
+            for block in iter(lambda: fin.read(1 << 20), b''):
+                sha.update(block)
+        key = '%s-%d-%s' % (sha.hexdigest(), max_len, self.lm)
+        if self.pair_budget:
+            key += '-pair'
+        return key
+
+
+    def transform_file(self, input_fn, max_len, overwrite=False,
+                       num_workers=1, chunk_size=1000):
         """Summarize all lines of a tsv file.
-        Run the summarizer. If the output already exists, just return the file name.
+        Run the summarizer. If the output already exists for the same input content,
+        max_len and tokenizer, just return the file name. The progress is checkpointed
+        every chunk_size lines in a .meta file, so an interrupted run resumes where it
+        stopped.
         Args:
             input_fn (str): the input file name
             max_len (int, optional): the max sequence len
             overwrite (bool, optional): if true, then overwrite any cached output
+            num_workers (int, optional): the number of processes (the line order is kept)
+            chunk_size (int, optional): the number of lines between two checkpoints
         Returns:
             str: the output file name
         """
         out_fn = input_fn + '.su'
-        if not os.path.exists(out_fn) or \
-            os.stat(out_fn).st_size == 0 or overwrite:
-            with open(out_fn, 'w') as fout:
-                for line in open(input_fn):
-                    fout.write(self.transform(line, max_len=max_len))
-        return out_fn
\ No newline at end of file
+        meta_fn = out_fn + '.meta'
+        key = self.cache_key(input_fn, max_len)
+
+        meta = {'key': key, 'lines': 0, 'offset': 0, 'complete': False}
+        if not overwrite and os.path.exists(meta_fn) and os.path.exists(out_fn):
+            with open(meta_fn) as fin:
+                saved = json.load(fin)
+            if saved['key'] == key:
+                if saved['complete']:
+                    return out_fn
+                meta = saved
+
+        lines = itertools.islice(open(input_fn), meta['lines'], None)
+        pool = None
+        if num_workers > 1:
+            pool = multiprocessing.Pool(num_workers,
+                                        initializer=_init_worker,
+                                        initargs=(self.config, self.lm, self.cache_dir,
+                                                  self.len_cache_size, self.pair_budget))
+            summaries = pool.imap(_transform_line,
+                                  ((line, max_len) for line in lines),
+                                  chunksize=max(1, chunk_size // (4 * num_workers)))
+        else:
+            summaries = (self.transform(line, max_len=max_len) for line in lines)
+
+        try:
+            with open(out_fn, 'ab' if meta['lines'] > 0 else 'wb') as fout:
+                # drop anything written after the last checkpoint
+                fout.truncate(meta['offset'])
+                for summary in summaries:
+                    fout.write(summary.encode('utf-8'))
+                    meta['lines'] += 1
+                    if meta['lines'] % chunk_size == 0:
+                        fout.flush()
+                        meta['offset'] = fout.tell()
+                        _save_meta(meta_fn, meta)
+                meta['offset'] = fout.tell()
+            meta['complete'] = True
+            _save_meta(meta_fn, meta)
+            if pool is not None:
+                # let the workers exit normally to save their length caches
+                pool.close()
+                pool.join()
+                pool = None
+        finally:
+            if pool is not None:
+                pool.terminate()
+        self.save_len_cache()
+        return out_fn
+
+
+def _save_meta(meta_fn, meta):
+    """Atomically write the checkpoint of transform_file"""
+    tmp_fn = meta_fn + '.tmp'
+    with open(tmp_fn, 'w') as fout:
+        json.dump(meta, fout)
+    os.replace(tmp_fn, meta_fn)
+
+
+_worker_summarizer = None
+
+
+def _init_worker(config, lm, cache_dir, len_cache_size, pair_budget):
+    """Create the Summarizer of a transform_file worker process"""
+    global _worker_summarizer
+    _worker_summarizer = Summarizer(config, lm,
+                                    cache_dir=cache_dir,
+                                    len_cache_size=len_cache_size,
+                                    pair_budget=pair_budget)
+    util.Finalize(_worker_summarizer, _worker_summarizer.save_len_cache, exitpriority=10)
+
+
+def _transform_line(args):
+    line, max_len = args
+    return _worker_summarizer.transform(line, max_len=max_len)
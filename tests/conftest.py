@@ -0,0 +1,6 @@
+import os
+import sys
+
+# the back translation modules (utils, back_trans_model, async_back_trans...)
+# are top-level scripts that import each other by name
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,207 @@
+import asyncio
+import collections
+import threading
+import time
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+
+import pytest
+import requests
+
+from async_back_trans import AsyncBackTranslate, RateLimiter
+from back_trans_model import BackTranslate
+from utils import sessionRequest
+
+
+class StubServer:
+    """A local translation server: a GET /?q=...&sl=...&tl=... returns the
+    query tagged with the target lang ('vi:q'), and untagged back to en.
+
+    The first fail[q] requests of a query fail with the status codes of
+    fail_codes, delay[q] (seconds) is slept before replying, and the
+    arrival time of every request is recorded.
+    """
+
+    def __init__(self):
+        self.fail = collections.defaultdict(int)
+        self.fail_codes = [429, 503]
+        self.delay = {}
+        self.arrivals = collections.defaultdict(list)
+        self.in_flight = self.max_in_flight = 0
+        self.lock = threading.Lock()
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def do_GET(self):
+                params = parse_qs(urlparse(self.path).query)
+                query, dst_lang = params['q'][0], params['tl'][0]
+                with server.lock:
+                    server.arrivals[(query, dst_lang)].append(time.monotonic())
+                    attempt = len(server.arrivals[(query, dst_lang)]) - 1
+                    server.in_flight += 1
+                    server.max_in_flight = max(server.max_in_flight, server.in_flight)
+                time.sleep(server.delay.get(query, 0.0))
+                with server.lock:
+                    server.in_flight -= 1
+
+                if attempt < server.fail[query]:
+                    code = server.fail_codes[attempt % len(server.fail_codes)]
+                    body = b'error'
+                else:
+                    code = 200
+                    if dst_lang == 'en':
+                        body = query.split(':', 1)[1].encode('utf-8')
+                    else:
+                        body = ('%s:%s' % (dst_lang, query)).encode('utf-8')
+                self.send_response(code)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+        self.httpd = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.url = 'http://127.0.0.1:%d/' % self.httpd.server_address[1]
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self.thread.start()
+
+    def close(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+class StubTranslator(BackTranslate):
+    provider = 'stub'
+
+    def __init__(self, url):
+        self.url = url
+        super().__init__(self._translate_sync, {'en': 'English', 'vi': 'Vietnamese'}, 'en')
+
+    def _request(self, query, src_lang, dst_lang):
+        return 'GET', self.url, {'params': {'q': query, 'sl': src_lang, 'tl': dst_lang}}
+
+    def _parse(self, body):
+        return body
+
+    def _translate_sync(self, query, src_lang, dst_lang):
+        method, url, kwargs = self._request(query, src_lang, dst_lang)
+        r = sessionRequest(method, url, **kwargs)
+        r.raise_for_status()
+        return self._parse(r.text)
+
+
+@pytest.fixture
+def server():
+    server = StubServer()
+    yield server
+    server.close()
+
+
+def test_retry_with_backoff(server):
+    queries = ['value %d' % i for i in range(10)]
+    for query in queries:
+        # a 429 then a 503 before the query is translated
+        server.fail[query] = 2
+    server.fail['never'] = 100
+
+    abt = AsyncBackTranslate(StubTranslator(server.url), max_retries=3, backoff=0.05)
+    out = abt.bulk_back_translate(queries + ['never'], mid_lang='vi')
+
+    assert out == queries + [None]
+    for query in queries:
+        arrivals = server.arrivals[(query, 'vi')]
+        assert len(arrivals) == 3
+        # backoff * 2 ** attempt * (1 + jitter)
+        assert arrivals[1] - arrivals[0] >= 0.05
+        assert arrivals[2] - arrivals[1] >= 0.1
+        # the translation back to en succeeds at once
+        assert len(server.arrivals[('vi:' + query, 'en')]) == 1
+    assert len(server.arrivals[('never', 'vi')]) == 4
+
+
+@pytest.mark.parametrize('use_aiohttp', [True, False])
+def test_no_retry_on_client_error(server, monkeypatch, use_aiohttp):
+    server.fail_codes = [401]
+    server.fail['denied'] = 100
+
+    abt = AsyncBackTranslate(StubTranslator(server.url), max_retries=5, backoff=1.0)
+    monkeypatch.setattr(abt, 'use_aiohttp', use_aiohttp)
+    start = time.monotonic()
+    out = abt.bulk_back_translate(['denied'], mid_lang='vi')
+
+    assert out == [None]
+    assert len(server.arrivals[('denied', 'vi')]) == 1
+    # no backoff either
+    assert time.monotonic() - start < 1.0
+
+
+def test_order_preserved_under_concurrency(server):
+    queries = ['value %d' % i for i in range(40)]
+    for i, query in enumerate(queries):
+        # the first queries are answered last
+        server.delay[query] = 0.01 * (len(queries) - i) / 4
+
+    abt = AsyncBackTranslate(StubTranslator(server.url), concurrency=8)
+    out = abt.bulk_back_translate(queries, mid_lang='vi')
+
+    assert out == queries
+    assert 1 < server.max_in_flight <= 8
+
+
+def test_order_preserved_without_aiohttp(server, monkeypatch):
+    queries = ['value %d' % i for i in range(20)]
+    for i, query in enumerate(queries):
+        server.delay[query] = 0.01 * (len(queries) - i) / 4
+        server.fail[query] = 1
+
+    abt = AsyncBackTranslate(StubTranslator(server.url), concurrency=8, backoff=0.01)
+    monkeypatch.setattr(abt, 'use_aiohttp', False)
+    out = abt.bulk_back_translate(queries, mid_lang='vi')
+
+    assert out == queries
+
+
+def test_rate_limiter_keeps_rate():
+    async def acquire_all(limiter, n):
+        times = []
+        for _ in range(n):
+            await limiter.acquire()
+            times.append(time.monotonic())
+        return times
+
+    rate, burst, n = 50.0, 5, 40
+    times = asyncio.run(acquire_all(RateLimiter(rate, burst=burst), n))
+    elapsed = times[-1] - times[0]
+    # the burst goes at once, the rest at the rate
+    assert elapsed >= (n - burst) / rate * 0.95
+    assert elapsed <= (n - burst) / rate * 2 + 0.2
+
+
+def test_requests_keep_configured_rate(server):
+    rate = 20.0
+    queries = ['value %d' % i for i in range(25)]
+
+    abt = AsyncBackTranslate(StubTranslator(server.url), concurrency=16, rate=rate)
+    start = time.monotonic()
+    out = abt.bulk_back_translate(queries, mid_lang='vi')
+    elapsed = time.monotonic() - start
+
+    assert out == queries
+    arrivals = sorted(t for times in server.arrivals.values() for t in times)
+    assert len(arrivals) == 2 * len(queries)
+    # the default burst is the rate: 50 requests take at least (50 - 20) / 20 s
+    assert elapsed >= (len(arrivals) - rate) / rate * 0.95
+    # and no 1 s window has more than the burst plus the rate
+    for i, t in enumerate(arrivals):
+        window = sum(1 for u in arrivals[i:] if u - t < 1.0)
+        assert window <= 2 * rate + 1
+
+
+def test_sync_request_timeout(server):
+    server.delay['stall'] = 2.0
+    start = time.monotonic()
+    with pytest.raises(requests.exceptions.Timeout):
+        sessionRequest('GET', server.url, timeout=0.2,
+                       params={'q': 'stall', 'sl': 'en', 'tl': 'vi'})
+    assert time.monotonic() - start < 1.5
@@ -0,0 +1,102 @@
+import argparse
+
+import torch
+import torch.nn as nn
+
+from ditto_light.dataset import TokenBudgetBatchSampler
+from ditto_light.ditto import train_step
+
+
+class BagModel(nn.Module):
+    """A deterministic stand-in for DittoModel: mean-pooled embeddings and
+    a linear classifier."""
+
+    device = 'cpu'
+
+    def __init__(self):
+        super().__init__()
+        self.emb = nn.Embedding(50, 8)
+        self.fc = nn.Linear(8, 2)
+
+    def forward(self, x, x_mask):
+        mask = x_mask.unsqueeze(-1).float()
+        return self.fc((self.emb(x) * mask).sum(1) / mask.sum(1))
+
+
+def make_pairs(num_pairs, seed=0):
+    gen = torch.Generator().manual_seed(seed)
+    x = torch.randint(1, 50, (num_pairs, 6), generator=gen)
+    lengths = torch.randint(2, 7, (num_pairs,), generator=gen)
+    x_mask = (torch.arange(6).unsqueeze(0) < lengths.unsqueeze(1)).long()
+    y = torch.randint(0, 2, (num_pairs,), generator=gen)
+    return x * x_mask, x_mask, y
+
+
+def split(pairs, sizes):
+    batches = []
+    start = 0
+    for size in sizes:
+        batches.append(tuple(t[start:start+size] for t in pairs))
+        start += size
+    return batches
+
+
+def run_steps(batches, batch_size, max_tokens):
+    """Return the parameter updates of every optimizer step of train_step"""
+    torch.manual_seed(123)
+    model = BagModel()
+    optimizer = torch.optim.SGD(model.parameters(), lr=1.0)
+    scheduler = torch.optim.lr_scheduler.LambdaLR(optimizer, lambda step: 1.0)
+    hp = argparse.Namespace(batch_size=batch_size, max_tokens=max_tokens)
+
+    updates = []
+    before = [p.detach().clone() for p in model.parameters()]
+
+    def on_step(num_batches):
+        after = [p.detach().clone() for p in model.parameters()]
+        updates.append([b - a for a, b in zip(before, after)])
+        before[:] = after
+
+    train_step(batches, model, optimizer, scheduler, hp, on_step=on_step)
+    return updates
+
+
+def assert_same_updates(accumulated, single):
+    assert len(accumulated) == len(single)
+    for acc_step, single_step in zip(accumulated, single):
+        for acc, ref in zip(acc_step, single_step):
+            assert torch.allclose(acc, ref, atol=1e-6)
+
+
+def test_accumulation_matches_single_batch():
+    pairs = make_pairs(8)
+    accumulated = run_steps(split(pairs, [3, 3, 2]), batch_size=8, max_tokens=64)
+    single = run_steps([pairs], batch_size=8, max_tokens=None)
+    assert_same_updates(accumulated, single)
+
+
+def test_accumulation_overshooting_batch_size():
+    # 5 + 5 pairs reach batch_size=8 at 10 pairs: the mean over the 10
+    pairs = make_pairs(10, seed=1)
+    accumulated = run_steps(split(pairs, [5, 5]), batch_size=8, max_tokens=64)
+    single = run_steps([pairs], batch_size=10, max_tokens=None)
+    assert_same_updates(accumulated, single)
+
+
+def test_accumulation_final_partial_step():
+    # 8 pairs make a full step, the last 5 a partial one weighted as a batch of 5
+    pairs = make_pairs(13, seed=2)
+    accumulated = run_steps(split(pairs, [4, 4, 3, 2]), batch_size=8, max_tokens=64)
+    single = run_steps(split(pairs, [8, 5]), batch_size=8, max_tokens=None)
+    assert_same_updates(accumulated, single)
+
+
+def test_token_budget_batches_within_limits():
+    lengths = [(i * 7) % 60 + 4 for i in range(1000)]
+    sampler = TokenBudgetBatchSampler(lengths, max_tokens=512, seed=0, max_size=32)
+    batches = sampler.batches()
+    assert sorted(idx for batch in batches for idx in batch) == list(range(1000))
+    for batch in batches:
+        assert len(batch) <= 32
+        assert len(batch) == 1 or max(lengths[idx] for idx in batch) * len(batch) <= 512
+    assert len(sampler) == len(batches)
@@ -0,0 +1,49 @@
+import numpy as np
+
+from ditto_light.embedding import BiEncoderScorer
+
+
+class LookupEncoder:
+    """Encode an entity to the unit vector at the angle given by its text,
+    so that the cosine similarity of a pair is set by its two angles."""
+
+    def encode(self, entities):
+        angles = np.array([float(ent) for ent in entities])
+        return np.stack([np.cos(angles), np.sin(angles)], axis=1)
+
+
+def make_rows(sims):
+    return [('0', str(np.arccos(sim))) for sim in sims]
+
+
+def test_calibrate_band():
+    sims = [0.1, 0.2, 0.3, 0.5, 0.6, 0.8, 0.9, 0.95]
+    labels = [0, 0, 0, 1, 0, 1, 1, 1]
+    scorer = BiEncoderScorer(LookupEncoder())
+    band = scorer.calibrate(make_rows(sims), labels, max_error=0.0)
+
+    # the widest band without an error: matches above 0.6, non-matches below 0.5
+    assert np.isclose(band['high'], 0.7)
+    assert np.isclose(band['low'], 0.4)
+    assert band['high_precision'] == band['low_precision'] == 1.0
+
+    predictions, confidences = scorer.decide(make_rows([0.99, 0.65, 0.45, 0.0]))
+    assert predictions == [1, None, None, 0]
+    assert confidences == [1.0, None, None, 1.0]
+
+
+def test_calibrate_fails_without_a_separating_threshold():
+    # all the similarities are high, as with an encoder not trained for it
+    sims = [0.96, 0.97, 0.98, 0.99]
+    labels = [1, 0, 1, 0]
+    scorer = BiEncoderScorer(LookupEncoder())
+    band = scorer.calibrate(make_rows(sims), labels, max_error=0.01)
+
+    assert band['high'] is None and band['low'] is None
+    assert not scorer.enabled()
+    assert scorer.decide(make_rows(sims)) == ([None] * 4, [None] * 4)
+
+
+def test_uncalibrated_scorer_decides_nothing():
+    scorer = BiEncoderScorer(LookupEncoder())
+    assert scorer.decide(make_rows([1.0, -1.0])) == ([None, None], [None, None])
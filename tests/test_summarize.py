@@ -0,0 +1,36 @@
+import random
+
+from ditto_light.benchmark import score_sentences_reference
+from ditto_light.summarize import Summarizer
+
+
+def make_summarizer():
+    # the scorer does not use the tokenizer
+    return Summarizer.__new__(Summarizer)
+
+
+def test_score_sentences_length_changing_lowercase():
+    # 'İ'.lower() has 2 code points
+    summarizer = make_summarizer()
+    words = ['İİİİ', 'ab', 'cd']
+    freq_table = {'ab': 2, 'cd': 5}
+    assert summarizer._score_sentences(words, freq_table) == \
+        score_sentences_reference(words, freq_table)
+
+
+def test_score_sentences_matches_reference_non_ascii():
+    summarizer = make_summarizer()
+    rng = random.Random(123)
+    alphabet = 'abcİIıßẞΣσςÅåé0'
+    for _ in range(200):
+        words = [''.join(rng.choice(alphabet) for _ in range(rng.randint(1, 6)))
+                 for _ in range(rng.randint(1, 12))]
+        # repeated words add to their previous score
+        words += rng.sample(words, rng.randint(0, len(words)))
+        freq_table = {}
+        for word in rng.sample(words, rng.randint(1, len(words))):
+            low = word.lower()
+            start = rng.randrange(len(low))
+            freq_table[low[start:start + rng.randint(1, 3)]] = rng.randint(1, 5)
+        assert summarizer._score_sentences(words, freq_table) == \
+            score_sentences_reference(words, freq_table)
@@ -8,6 +8,29 @@ import re
 import html
 from urllib import parse
 import requests
+from requests.adapters import HTTPAdapter
+
+_session = None
+# the default timeout (in seconds) of a request, so that a stalled
+# connection cannot hang a translation forever
+RequestTimeout = 30
+
+
+def getSession(pool_size=32):
+    '''Returns the requests session shared by the translators, so that 
+    consecutive requests reuse pooled keep-alive connections.'''
+    global _session
+    if _session is None:
+        _session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        _session.mount('http://', adapter)
+        _session.mount('https://', adapter)
+    return _session
+
+
+def sessionRequest(method, url, timeout=RequestTimeout, **kwargs):
+    '''Sends a request with the shared session and a timeout (in seconds).'''
+    return getSession().request(method, url, timeout=timeout, **kwargs)
 
 
 def getLangDict(path='langDict.json'):
@@ -80,16 +103,25 @@ def find_lang_code(dic, lang, rev_dic=None, warning=False):
         raise ValueError(f'Lang code not found for "{lang}"')
 
         
-def gTransByRegex(text, src_lang, dst_lang):
-    '''A simple web crawling method for accessing Google Translate (may 
-    not be realiable and ethical for large-scale translation). 
-    '''
-    gTransTmpUrl = 'http://translate.google.cn/m?q=%s&tl=%s&sl=%s'
+def gTransRequest(text, src_lang, dst_lang, gTransTmpUrl='http://translate.google.cn/m?q=%s&tl=%s&sl=%s'):
+    '''Returns the request (method, url and keyword arguments) of gTransByRegex.'''
     text = parse.quote(text)
     url = gTransTmpUrl % (text, dst_lang, src_lang)
-    
-    r = requests.get(url)
+    return 'GET', url, {}
+
+
+def gTransParse(body):
+    '''Extracts the translated text from the page returned for gTransRequest.'''
     tar_ptn = r'(?s)class="(?:t0|result-container)">(.*?)<'
-    result = re.findall(tar_ptn, r.text)
+    result = re.findall(tar_ptn, body)
     
     return html.unescape(result[0])
+
+
+def gTransByRegex(text, src_lang, dst_lang, **kwargs):
+    '''A simple web crawling method for accessing Google Translate (may 
+    not be realiable and ethical for large-scale translation). 
+    '''
+    method, url, kwargs = gTransRequest(text, src_lang, dst_lang, **kwargs)
+    r = sessionRequest(method, url, **kwargs)
+    return gTransParse(r.text)